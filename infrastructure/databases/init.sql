@@ -77,7 +77,8 @@ CREATE TABLE orders.outbox_events (
     event_data JSONB NOT NULL,
     processed BOOLEAN DEFAULT false,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    processed_at TIMESTAMP
+    processed_at TIMESTAMP,
+    claimed_until TIMESTAMP -- lease held by an outbox processor while it publishes the event
 );
 
 -- Order saga state tracking
@@ -106,6 +107,10 @@ CREATE INDEX idx_orders_status ON orders.orders(status);
 CREATE INDEX idx_orders_created_at ON orders.orders(created_at);
 CREATE INDEX idx_outbox_events_processed ON orders.outbox_events(processed);
 CREATE INDEX idx_outbox_events_created_at ON orders.outbox_events(created_at);
+-- Partial index for the outbox claim query (FOR UPDATE SKIP LOCKED ordered by id)
+CREATE INDEX idx_outbox_events_unprocessed ON orders.outbox_events(id) WHERE processed = false;
+CREATE INDEX idx_outbox_events_processed_at ON orders.outbox_events(processed_at) WHERE processed = true;
+CREATE INDEX idx_outbox_events_unprocessed_aggregate ON orders.outbox_events(aggregate_id, id) WHERE processed = false;
 
 -- ================================================
 -- PAYMENT SERVICE SCHEMA
@@ -156,7 +161,7 @@ CREATE TABLE payments.service_logs (
 CREATE INDEX idx_payments_order_id ON payments.payments(order_id);
 CREATE INDEX idx_payments_status ON payments.payments(status);
 CREATE INDEX idx_payments_idempotency_key ON payments.payments(idempotency_key);
-CREATE INDEX idx_payment_attempts_payment_id ON payments.payment_attempts(payment_id);
+CREATE UNIQUE INDEX idx_payment_attempts_payment_attempt ON payments.payment_attempts(payment_id, attempt_number);
 
 -- ================================================
 -- NOTIFICATION SERVICE SCHEMA
@@ -250,6 +255,19 @@ CREATE TRIGGER update_payments_updated_at
     BEFORE UPDATE ON payments.payments 
     FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
 
+-- Wake up outbox processors (LISTEN outbox_new) as soon as events are committed
+CREATE OR REPLACE FUNCTION orders.notify_outbox_new()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('outbox_new', '');
+    RETURN NULL;
+END;
+$$ language 'plpgsql';
+
+CREATE TRIGGER outbox_events_notify
+    AFTER INSERT ON orders.outbox_events
+    FOR EACH STATEMENT EXECUTE FUNCTION orders.notify_outbox_new();
+
 -- ================================================
 -- GRANTS AND PERMISSIONS
 -- ================================================
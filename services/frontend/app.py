@@ -15,7 +15,7 @@ from flask_cors import CORS
 # Add shared module to path
 sys.path.insert(0, '/app/shared')
 
-from base_service import BaseService, generate_id, validate_required_fields, ValidationError
+from base_service import BaseService, generate_id, iso_now_fast, validate_required_fields, ValidationError
 
 
 class FrontendService(BaseService):
@@ -159,7 +159,8 @@ class FrontendService(BaseService):
                 pizza = self.db.execute_query(
                     "SELECT * FROM frontend.pizzas WHERE id = %s",
                     (pizza_id,),
-                    fetch='one'
+                    fetch='one',
+                    prepared_name='get_pizza_by_id'
                 )
                 
                 if not pizza:
@@ -373,7 +374,7 @@ class FrontendService(BaseService):
                         'total_pizzas': total_pizzas,
                         'available_pizzas': available_pizzas,
                         'service': 'frontend-service',
-                        'version': os.getenv('SERVICE_VERSION', '1.0.0'),
+                        'version': self.config.SERVICE_VERSION,
                         'uptime': time.time() - self.start_time
                     },
                     'timestamp': self.get_timestamp()
@@ -552,14 +553,20 @@ class FrontendService(BaseService):
 
     def get_timestamp(self) -> str:
         """Get current timestamp in ISO format"""
-        from datetime import datetime, timezone
-        return datetime.now(timezone.utc).isoformat()
+        return iso_now_fast()
 
 
 # ========================================
 # Application Entry Point
 # ========================================
 
+def create_app():
+    """WSGI application factory used by gunicorn"""
+    service = FrontendService()
+    service.logger.info("🍕 Starting Frontend Service under gunicorn")
+    return service.app
+
+
 if __name__ == '__main__':
     try:
         # Create and run service
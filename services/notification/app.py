@@ -13,13 +13,12 @@ import time
 from typing import Dict, List, Any, Optional
 from flask import request, jsonify
 from flask_cors import CORS
-from datetime import datetime, timezone
 from enum import Enum
 
 # Add shared module to path
 sys.path.insert(0, '/app/shared')
 
-from base_service import BaseService, generate_id, validate_required_fields, ValidationError, retry_with_backoff
+from base_service import BaseService, generate_id, iso_now_fast, event_preview, validate_required_fields, ValidationError, retry_with_backoff
 
 
 class NotificationType(Enum):
@@ -38,6 +37,17 @@ class NotificationStatus(Enum):
     DELIVERED = "DELIVERED"
 
 
+# Plain strings for the send path (avoids Enum attribute lookups per notification)
+_EMAIL = NotificationType.EMAIL.value
+_SMS = NotificationType.SMS.value
+_PUSH = NotificationType.PUSH.value
+_WEBHOOK = NotificationType.WEBHOOK.value
+VALID_CHANNELS = frozenset(t.value for t in NotificationType)
+
+_SENT = NotificationStatus.SENT.value
+_FAILED = NotificationStatus.FAILED.value
+
+
 class NotificationService(BaseService):
     """Notification Service for sending user notifications"""
     
@@ -123,8 +133,7 @@ class NotificationService(BaseService):
                 priority = data.get('priority', 'normal')
                 
                 # Validate channels
-                valid_channels = [t.value for t in NotificationType]
-                invalid_channels = [c for c in channels if c not in valid_channels]
+                invalid_channels = [c for c in channels if c not in VALID_CHANNELS]
                 if invalid_channels:
                     raise ValidationError(f"Invalid channels: {', '.join(invalid_channels)}")
                 
@@ -199,7 +208,8 @@ class NotificationService(BaseService):
                     RETURNING *
                     """,
                     (notification_id, user_id, order_id, subject, message, channels, priority, template_type),
-                    fetch='one'
+                    fetch='one',
+                    prepared_name='insert_notification'
                 )
         except Exception as e:
             self.logger.error("Failed to create notification record", error=str(e))
@@ -240,11 +250,11 @@ class NotificationService(BaseService):
             
             # Update notification status
             if success_count == total_channels:
-                self.update_notification_status(notification_id, NotificationStatus.SENT.value)
+                self.update_notification_status(notification_id, _SENT)
                 self.logger.info("All notifications sent successfully", notification_id=notification_id)
                 self.metrics.record_business_event('notification_sent', 'success')
             elif success_count > 0:
-                self.update_notification_status(notification_id, NotificationStatus.SENT.value)
+                self.update_notification_status(notification_id, _SENT)
                 self.logger.warning(
                     "Partial notification success",
                     notification_id=notification_id,
@@ -253,13 +263,13 @@ class NotificationService(BaseService):
                 )
                 self.metrics.record_business_event('notification_sent', 'partial')
             else:
-                self.update_notification_status(notification_id, NotificationStatus.FAILED.value)
+                self.update_notification_status(notification_id, _FAILED)
                 self.logger.error("All notification channels failed", notification_id=notification_id)
                 self.metrics.record_business_event('notification_sent', 'failed')
                 
         except Exception as e:
             self.logger.error("Notification async sending error", notification_id=notification_id, error=str(e))
-            self.update_notification_status(notification_id, NotificationStatus.FAILED.value)
+            self.update_notification_status(notification_id, _FAILED)
     
     def send_through_channel(self, notification: Dict, channel: str, contact_info: Dict) -> bool:
         """Send notification through specific channel"""
@@ -272,13 +282,13 @@ class NotificationService(BaseService):
             success = False
             error_message = None
             
-            if channel == NotificationType.EMAIL.value and self.email_enabled:
+            if channel == _EMAIL and self.email_enabled:
                 success = self.send_email_notification(notification, contact_info)
-            elif channel == NotificationType.SMS.value and self.sms_enabled:
+            elif channel == _SMS and self.sms_enabled:
                 success = self.send_sms_notification(notification, contact_info)
-            elif channel == NotificationType.PUSH.value and self.push_enabled:
+            elif channel == _PUSH and self.push_enabled:
                 success = self.send_push_notification(notification, contact_info)
-            elif channel == NotificationType.WEBHOOK.value and self.webhook_enabled:
+            elif channel == _WEBHOOK and self.webhook_enabled:
                 success = self.send_webhook_notification(notification, contact_info)
             else:
                 error_message = f"Channel {channel} is not enabled or not supported"
@@ -490,18 +500,20 @@ class NotificationService(BaseService):
         def consume_events():
             self.logger.info("Starting event consumer for payment and order events")
             
+            backoff = 1
             while True:
                 try:
                     self.events.process_events(
                         topics=['payment-events', 'order-events'],
                         group_id='notification-service-group',
                         handler_func=self.handle_event,
-                        max_messages=10
+                        max_messages=500
                     )
-                    time.sleep(1)
+                    backoff = 1
                 except Exception as e:
                     self.logger.error("Event consumer error", error=str(e))
-                    time.sleep(5)
+                    time.sleep(backoff)  # Exponential backoff while Kafka is unavailable
+                    backoff = min(backoff * 2, 30)
         
         consumer_thread = threading.Thread(target=consume_events, daemon=True)
         consumer_thread.start()
@@ -512,7 +524,8 @@ class NotificationService(BaseService):
         event_type = event_data.get('event_type')
         order_id = event_data.get('orderId') or event_data.get('order_id')
             
-        self.logger.info("Processing event for notification", topic=topic, event_type=event_type, order_id=order_id)
+        if self.log_info:
+            self.logger.info("Processing event for notification", topic=topic, event_type=event_type, order_id=order_id)
         
         try:
             if event_type == 'OrderCreated':
@@ -534,7 +547,7 @@ class NotificationService(BaseService):
         
         # Ensure order_id is present
         if not order_id:
-            self.logger.warning("OrderCreated event missing orderId", event_data=event_data)
+            self.logger.warning("OrderCreated event missing orderId", event_preview=event_preview(event_data))
             return
 
         template = self.get_template('OrderCreated')
@@ -559,7 +572,7 @@ class NotificationService(BaseService):
         order_id = event_data.get('order_id')
         
         if not order_id:
-            self.logger.warning("OrderPaid event missing order_id", event_data=event_data)
+            self.logger.warning("OrderPaid event missing order_id", event_preview=event_preview(event_data))
             return
 
         template = self.get_template('OrderPaid')
@@ -584,7 +597,7 @@ class NotificationService(BaseService):
         order_id = event_data.get('order_id')
         
         if not order_id:
-            self.logger.warning("PaymentFailed event missing order_id", event_data=event_data)
+            self.logger.warning("PaymentFailed event missing order_id", event_preview=event_preview(event_data))
             return
 
         template = self.get_template('PaymentFailed')
@@ -609,7 +622,8 @@ class NotificationService(BaseService):
             return self.db.execute_query(
                 "SELECT * FROM notifications.notification_templates WHERE type = %s",
                 (template_type,),
-                fetch='one'
+                fetch='one',
+                prepared_name='get_notification_template'
             )
         except Exception as e:
             self.logger.error("Failed to get notification template", template_type=template_type, error=str(e))
@@ -639,13 +653,20 @@ class NotificationService(BaseService):
     
     def get_timestamp(self) -> str:
         """Get current timestamp in ISO format"""
-        return datetime.now(timezone.utc).isoformat()
+        return iso_now_fast()
 
 
 # ========================================
 # Application Entry Point
 # ========================================
 
+def create_app():
+    """WSGI application factory used by gunicorn"""
+    service = NotificationService()
+    service.logger.info("📢 Starting Notification Service under gunicorn")
+    return service.app
+
+
 if __name__ == '__main__':
     try:
         # Create and run service
@@ -10,15 +10,66 @@ import sys
 import json
 import threading
 import time
-from typing import Dict, List, Any, Optional
+from typing import Annotated, Dict, List, Any, Literal, Optional, Tuple
 from flask import request, jsonify
 from flask_cors import CORS
-from datetime import datetime, timezone
+import msgspec
+import redis
+import requests
+from requests.adapters import HTTPAdapter
 
 # Add shared module to path
 sys.path.insert(0, '/app/shared')
 
-from base_service import BaseService, generate_id, validate_required_fields, ValidationError, retry_with_backoff
+from base_service import BaseService, generate_id, iso_now_fast, event_preview, ValidationError, retry_with_backoff
+
+
+# ========================================
+# Request Schemas
+# ========================================
+
+class OrderItemRequest(msgspec.Struct):
+    """Single pizza position of a new order"""
+    pizzaId: str
+    quantity: int = 1
+
+
+class CreateOrderRequest(msgspec.Struct):
+    """Body of POST /api/v1/orders"""
+    items: Annotated[List[OrderItemRequest], msgspec.Meta(min_length=1)]
+    deliveryAddress: str
+    paymentMethod: str
+    userId: str = 'anonymous'
+
+
+class UpdateOrderStatusRequest(msgspec.Struct):
+    """Body of PUT /api/v1/orders/<order_id>/status"""
+    status: Literal['PENDING', 'PROCESSING', 'PAID', 'FAILED', 'COMPLETED']
+    reason: str = ''
+
+
+class PaymentEvent(msgspec.Struct):
+    """Payment event consumed from the payment-events topic"""
+    event_type: Optional[str] = None
+    order_id: Optional[str] = None
+    failure_reason: Optional[str] = None
+
+
+def decode_payment_event(raw: bytes) -> PaymentEvent:
+    """Decode a Kafka payment event directly into a PaymentEvent (raises msgspec.DecodeError on bad records)"""
+    return msgspec.json.decode(raw, type=PaymentEvent)
+
+
+def decode_request(schema: type):
+    """Parse and validate the current request body in a single pass"""
+    try:
+        return msgspec.json.decode(request.get_data(), type=schema)
+    except msgspec.DecodeError as e:
+        raise ValidationError(str(e))
+
+
+# Orders in these statuses no longer change and can be cached for longer
+TERMINAL_ORDER_STATUSES = frozenset({'COMPLETED', 'FAILED'})
 
 
 class OrderService(BaseService):
@@ -30,6 +81,21 @@ class OrderService(BaseService):
         # Enable CORS for web UI
         CORS(self.app, origins=['*'])
         
+        # Redis cache for order reads (disabled when REDIS_URL is not set)
+        redis_url = os.getenv('REDIS_URL')
+        self.order_cache = redis.Redis.from_url(redis_url) if redis_url else None
+        self.order_cache_ttl = int(os.getenv('ORDER_CACHE_TTL', '30'))
+        self.order_cache_terminal_ttl = int(os.getenv('ORDER_CACHE_TERMINAL_TTL', '3600'))
+        
+        # Pizza details are looked up in the Frontend Service menu
+        self.frontend_menu_url = f"{os.getenv('FRONTEND_SERVICE_URL', 'http://frontend-service:5000')}/api/v1/menu"
+        
+        # Keep-alive connection pool for menu lookups, shared by all request threads
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=0)
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+        
         # Setup routes
         self.setup_routes()
         
@@ -50,36 +116,27 @@ class OrderService(BaseService):
         def create_order():
             """Create new pizza order with Outbox Pattern"""
             try:
-                data = request.get_json()
-                
-                # Validate required fields
-                required_fields = ['items', 'deliveryAddress', 'paymentMethod']
-                missing_fields = validate_required_fields(data, required_fields)
-                
-                if missing_fields:
-                    raise ValidationError(f"Missing required fields: {', '.join(missing_fields)}")
-                
-                # Validate items
-                if not data['items'] or len(data['items']) == 0:
-                    raise ValidationError("Order must contain at least one item")
+                # Parse and validate the body against the schema
+                data = decode_request(CreateOrderRequest)
+                items = msgspec.to_builtins(data.items)
                 
                 # Generate order ID
                 order_id = generate_id('order_')
-                user_id = data.get('userId', 'anonymous')
+                user_id = data.userId
                 
                 # Get pizza details from Frontend Service
-                pizza_details = self.get_pizza_details(data['items'])
+                pizza_details = self.get_pizza_details(items)
                 total_amount = self.calculate_total(pizza_details)
                 
                 # Create order using transaction with Outbox Pattern
                 order_data = self.create_order_with_outbox(
                     order_id=order_id,
                     user_id=user_id,
-                    items=data['items'],
+                    items=items,
                     pizza_details=pizza_details,
                     total_amount=total_amount,
-                    delivery_address=data['deliveryAddress'],
-                    payment_method=data['paymentMethod']
+                    delivery_address=data.deliveryAddress,
+                    payment_method=data.paymentMethod
                 )
                 
                 self.logger.info(
@@ -87,7 +144,7 @@ class OrderService(BaseService):
                     order_id=order_id,
                     user_id=user_id,
                     total_amount=total_amount,
-                    items_count=len(data['items'])
+                    items_count=len(items)
                 )
                 
                 self.metrics.record_business_event('order_created', 'success')
@@ -122,17 +179,22 @@ class OrderService(BaseService):
         def get_order(order_id: str):
             """Get order details by ID"""
             try:
-                order = self.get_order_by_id(order_id)
-                
-                if not order:
-                    return jsonify({
-                        'success': False,
-                        'error': 'Order not found'
-                    }), 404
+                order = self.get_cached_order(order_id)
                 
-                # Get order items
-                order_items = self.get_order_items(order_id)
-                order['items'] = order_items
+                if order is None:
+                    order = self.get_order_by_id(order_id)
+                    
+                    if not order:
+                        return jsonify({
+                            'success': False,
+                            'error': 'Order not found'
+                        }), 404
+                    
+                    # Get order items
+                    order_items = self.get_order_items(order_id)
+                    order['items'] = order_items
+                    
+                    self.cache_order(order)
                 
                 self.logger.info("Order retrieved", order_id=order_id)
                 self.metrics.record_business_event('order_retrieved', 'success')
@@ -191,17 +253,10 @@ class OrderService(BaseService):
         def update_order_status(order_id: str):
             """Update order status (internal API)"""
             try:
-                data = request.get_json()
-                new_status = data.get('status')
-                reason = data.get('reason', '')
-                
-                if not new_status:
-                    raise ValidationError("Status is required")
-                
-                # Valid status transitions
-                valid_statuses = ['PENDING', 'PROCESSING', 'PAID', 'FAILED', 'COMPLETED']
-                if new_status not in valid_statuses:
-                    raise ValidationError(f"Invalid status. Must be one of: {valid_statuses}")
+                # Status must be one of the schema's valid statuses
+                data = decode_request(UpdateOrderStatusRequest)
+                new_status = data.status
+                reason = data.reason
                 
                 success = self.update_order_status_internal(order_id, new_status, reason)
                 
@@ -242,9 +297,6 @@ class OrderService(BaseService):
     def get_pizza_details(self, items: List[Dict]) -> List[Dict]:
         """Get pizza details from Frontend Service"""
         try:
-            import requests
-            
-            frontend_url = os.getenv('FRONTEND_SERVICE_URL', 'http://frontend-service:5000')
             pizza_details = []
             
             for item in items:
@@ -255,7 +307,7 @@ class OrderService(BaseService):
                     raise ValidationError("Pizza ID is required for each item")
                 
                 # Get pizza from Frontend Service
-                response = requests.get(f"{frontend_url}/api/v1/menu/{pizza_id}", timeout=10)
+                response = self.http.get(f"{self.frontend_menu_url}/{pizza_id}", timeout=10)
                 
                 if response.status_code == 404:
                     raise ValidationError(f"Pizza not found: {pizza_id}")
@@ -294,7 +346,7 @@ class OrderService(BaseService):
         with self.db.transaction():
             with self.db.get_cursor() as cursor:
                 # 1. Create Order
-                cursor.execute("""
+                self.db.execute_prepared(cursor, 'insert_order', """
                     INSERT INTO orders.orders (id, user_id, status, total, delivery_address, payment_method)
                     VALUES (%s, %s, %s, %s, %s, %s)
                 """, (
@@ -347,7 +399,7 @@ class OrderService(BaseService):
                     'timestamp': self.get_timestamp()
                 }
 
-                cursor.execute("""
+                self.db.execute_prepared(cursor, 'insert_outbox_event', """
                     INSERT INTO orders.outbox_events (aggregate_id, event_type, event_data)
                     VALUES (%s, %s, %s::jsonb)
                 """, (order_id, 'OrderCreated', json.dumps(event_data)))
@@ -366,7 +418,8 @@ class OrderService(BaseService):
         return self.db.execute_query(
             "SELECT * FROM orders.orders WHERE id = %s",
             (order_id,),
-            fetch='one'
+            fetch='one',
+            prepared_name='get_order_by_id'
         )
 
     def get_order_items(self, order_id: str) -> List[Dict]:
@@ -374,9 +427,43 @@ class OrderService(BaseService):
         return self.db.execute_query(
             "SELECT * FROM orders.order_items WHERE order_id = %s",
             (order_id,),
-            fetch='all'
+            fetch='all',
+            prepared_name='get_order_items'
         )
     
+    def get_cached_order(self, order_id: str) -> Optional[Dict]:
+        """Get order with items from Redis cache"""
+        if self.order_cache is None:
+            return None
+        
+        try:
+            cached = self.order_cache.get(f"order:{order_id}")
+            return self.app.json.loads(cached) if cached else None
+        except Exception as e:
+            self.logger.warning("Order cache read failed", order_id=order_id, error=str(e))
+            return None
+    
+    def cache_order(self, order: Dict):
+        """Store order with items in Redis cache"""
+        if self.order_cache is None:
+            return
+        
+        ttl = self.order_cache_terminal_ttl if order['status'] in TERMINAL_ORDER_STATUSES else self.order_cache_ttl
+        try:
+            self.order_cache.setex(f"order:{order['id']}", ttl, self.app.json.dumps(order))
+        except Exception as e:
+            self.logger.warning("Order cache write failed", order_id=order['id'], error=str(e))
+    
+    def invalidate_cached_order(self, order_id: str):
+        """Drop order from Redis cache after its status changed"""
+        if self.order_cache is None:
+            return
+        
+        try:
+            self.order_cache.delete(f"order:{order_id}")
+        except Exception as e:
+            self.logger.warning("Order cache invalidation failed", order_id=order_id, error=str(e))
+    
     def list_orders_with_filters(self, user_id: str = None, status: str = None, 
                                 limit: int = 50, offset: int = 0) -> List[Dict]:
         """List orders with optional filters"""
@@ -401,7 +488,9 @@ class OrderService(BaseService):
         with self.db.transaction():
             with self.db.get_cursor() as cursor:
                 # Update order status
-                cursor.execute(
+                self.db.execute_prepared(
+                    cursor,
+                    'update_order_status',
                     "UPDATE orders.orders SET status = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
                     (new_status, order_id)
                 )
@@ -418,19 +507,23 @@ class OrderService(BaseService):
                     'timestamp': self.get_timestamp()
                 }
 
-                cursor.execute("""
+                self.db.execute_prepared(cursor, 'insert_outbox_event', """
                     INSERT INTO orders.outbox_events (aggregate_id, event_type, event_data)
                     VALUES (%s, %s, %s::jsonb)
                 """, (order_id, 'OrderStatusChanged', json.dumps(event_data)))
                 
-                self.logger.info(
-                    "📤 OrderStatusChanged event added to outbox",
-                    order_id=order_id,
-                    new_status=new_status,
-                    reason=reason,
-                    outbox_event="Status change event queued for publishing"
-                )
+                if self.log_info:
+                    self.logger.info(
+                        "📤 OrderStatusChanged event added to outbox",
+                        order_id=order_id,
+                        new_status=new_status,
+                        reason=reason,
+                        outbox_event="Status change event queued for publishing"
+                    )
         
+        # Invalidate after commit. A reader that loaded the row before the commit can still re-cache the
+        # old status afterwards; that entry then lives out its TTL (ORDER_CACHE_TTL for non-terminal statuses)
+        self.invalidate_cached_order(order_id)
         return True
     
     def start_event_consumer(self):
@@ -438,106 +531,185 @@ class OrderService(BaseService):
         def consume_events():
             self.logger.info("🔄 Starting event consumer for payment events")
             
+            backoff = 1
             while True:
                 try:
                     self.logger.debug("📡 POLLING payment-events topic for new messages...")
                     self.events.process_events(
                         topics=['payment-events'],
                         group_id='order-service-group',
-                        handler_func=self.handle_payment_event,
-                        max_messages=10
+                        handler_func=self.handle_payment_events,
+                        max_messages=500,
+                        # Raw bytes: records are decoded in the handler, where a bad one can be skipped
+                        # (a deserializer error inside poll() would stall the partition on that offset)
+                        value_deserializer=lambda raw: raw,
+                        batch=True
                     )
-                    time.sleep(1)  # Small delay between polling
+                    backoff = 1
                 except Exception as e:
                     self.logger.error("Event consumer error", error=str(e))
-                    time.sleep(5)  # Wait before retrying
+                    time.sleep(backoff)  # Exponential backoff while Kafka is unavailable
+                    backoff = min(backoff * 2, 30)
         
         consumer_thread = threading.Thread(target=consume_events, daemon=True)
         consumer_thread.start()
         self.logger.info("Event consumer thread started")
     
-    def handle_payment_event(self, topic: str, event_data: Dict, key: str):
-        """Handle payment events (OrderPaid, PaymentFailed)"""
+    def handle_payment_events(self, messages: List[Tuple[str, bytes, str]]):
+        """Handle a polled batch of payment events; all order updates share one transaction"""
+        events = []
+        for topic, raw, key in messages:
+            try:
+                events.append((topic, decode_payment_event(raw), key))
+            except msgspec.DecodeError as e:  # includes msgspec.ValidationError (wrong field types)
+                self.logger.error("Skipping undecodable payment event", topic=topic, key=key,
+                                  error=str(e), event_preview=event_preview(raw))
+                self.metrics.record_business_event('payment_event_processed', 'failed')
+        
+        if not events:
+            return
+        
         try:
-            event_type = event_data.get('event_type')
-            order_id = event_data.get('order_id')
-            
-            if not order_id:
-                self.logger.warning("Payment event missing order_id", event_data=event_data)
-                return
-            
-            self.logger.info(
-                "📥 Received new payment event from Kafka",
-                event_type=event_type,
-                order_id=order_id,
-                message="Processing payment event from payment-events topic"
-            )
-            
-            if event_type == 'OrderPaid':
-                self.handle_order_paid(order_id, event_data)
-            elif event_type == 'PaymentFailed':
-                self.handle_payment_failed(order_id, event_data)
-            else:
-                self.logger.warning("Unknown payment event type", event_type=event_type)
-            
-            self.metrics.record_business_event('payment_event_processed', 'success')
-            
+            with self.db.transaction():
+                updated = [order_id for _, event, _ in events
+                           if (order_id := self.apply_payment_event(event)) is not None]
         except Exception as e:
-            self.logger.error("Failed to handle payment event", error=str(e), event_data=event_data)
-            self.metrics.record_business_event('payment_event_processed', 'failed')
+            # One bad event must not lose the rest of the batch
+            self.logger.error("Batch payment event handling failed, retrying events one by one",
+                              size=len(events), error=str(e))
+            for topic, event, key in events:
+                self.handle_payment_event(topic, event, key)
+            return
+        
+        # Invalidate after the batch commit (a racing reader may still re-cache the old status until its TTL expires)
+        for order_id in updated:
+            self.invalidate_cached_order(order_id)
+        for _ in events:
+            self.metrics.record_business_event('payment_event_processed', 'success')
     
-    def handle_order_paid(self, order_id: str, event_data: Dict):
-        """Handle successful payment"""
+    def handle_payment_event(self, topic: str, event: PaymentEvent, key: str):
+        """Handle a single payment event (OrderPaid, PaymentFailed)"""
         try:
-            self.update_order_status_internal(order_id, 'PAID', 'Payment successful')
-            
-            # Update saga state
-            with self.db.transaction():
-                with self.db.get_cursor() as cursor:
-                    cursor.execute("""
-                        UPDATE order_saga_state 
-                        SET current_step = 'payment_processed',
-                            steps_completed = array_append(steps_completed, 'payment_processed'),
-                            updated_at = CURRENT_TIMESTAMP
-                        WHERE order_id = %s
-                    """, (order_id,))
-            
-            self.logger.info("Order marked as PAID", order_id=order_id)
-            
+            order_id = self.apply_payment_event(event)
+            # Invalidate after commit; stale re-caches by racing readers are bounded by the cache TTL
+            if order_id is not None:
+                self.invalidate_cached_order(order_id)
+            self.metrics.record_business_event('payment_event_processed', 'success')
         except Exception as e:
-            self.logger.error("Failed to handle order paid", order_id=order_id, error=str(e))
+            self.logger.error("Failed to handle payment event", error=str(e),
+                              event_type=event.event_type, order_id=event.order_id)
+            self.metrics.record_business_event('payment_event_processed', 'failed')
     
-    def handle_payment_failed(self, order_id: str, event_data: Dict):
-        """Handle failed payment"""
-        try:
-            failure_reason = event_data.get('failure_reason', 'Payment processing failed')
-            self.update_order_status_internal(order_id, 'FAILED', failure_reason)
-            
-            # Update saga state for failure
-            with self.db.transaction():
-                with self.db.get_cursor() as cursor:
-                    cursor.execute("""
-                        UPDATE order_saga_state 
-                        SET current_step = 'failed',
-                            compensation_needed = true,
+    def apply_payment_event(self, event: PaymentEvent) -> Optional[str]:
+        """Apply a payment outcome to its order; returns the order ID if it was updated (DB errors propagate)"""
+        event_type = event.event_type
+        order_id = event.order_id
+        
+        if not order_id:
+            self.logger.warning("Payment event missing order_id", event_type=event.event_type)
+            return None
+        
+        self.logger.debug("Received payment event", event_type=event_type, order_id=order_id)
+        
+        if event_type == 'OrderPaid':
+            new_status = 'PAID'
+            updated = self.apply_payment_outcome(
+                order_id,
+                new_status=new_status,
+                reason='Payment successful',
+                saga_step='payment_processed',
+                completed_steps=['payment_processed']
+            )
+        elif event_type == 'PaymentFailed':
+            new_status = 'FAILED'
+            updated = self.apply_payment_outcome(
+                order_id,
+                new_status=new_status,
+                reason=event.failure_reason or 'Payment processing failed',
+                saga_step='failed',
+                compensation_needed=True
+            )
+        else:
+            self.logger.warning("Unknown payment event type", event_type=event_type)
+            return None
+        
+        if not updated:
+            self.logger.warning("Order not found for payment event", order_id=order_id)
+            return None
+        
+        if self.log_info:
+            self.logger.info("Order status updated from payment event", order_id=order_id, new_status=new_status)
+        return order_id
+    
+    def apply_payment_outcome(self, order_id: str, new_status: str, reason: str, saga_step: str,
+                              completed_steps: List[str] = None, compensation_needed: bool = False) -> bool:
+        """Update order status, saga state and outbox in a single statement (caller invalidates the cache after commit)"""
+        event_data = {
+            'event_type': 'OrderStatusChanged',
+            'orderId': order_id,
+            'newStatus': new_status,
+            'reason': reason,
+            'timestamp': self.get_timestamp()
+        }
+        
+        with self.db.transaction():
+            with self.db.get_cursor() as cursor:
+                self.db.execute_prepared(cursor, 'apply_payment_outcome', """
+                    WITH updated_order AS (
+                        UPDATE orders.orders
+                        SET status = %s, updated_at = CURRENT_TIMESTAMP
+                        WHERE id = %s
+                        RETURNING id
+                    ), updated_saga AS (
+                        UPDATE orders.order_saga_state
+                        SET current_step = %s,
+                            steps_completed = steps_completed || %s::text[],
+                            compensation_needed = compensation_needed OR %s,
                             updated_at = CURRENT_TIMESTAMP
-                        WHERE order_id = %s
-                    """, (order_id,))
-            
-            self.logger.info("Order marked as FAILED", order_id=order_id, reason=failure_reason)
-            
-        except Exception as e:
-            self.logger.error("Failed to handle payment failed", order_id=order_id, error=str(e))
+                        WHERE order_id IN (SELECT id FROM updated_order)
+                    )
+                    INSERT INTO orders.outbox_events (aggregate_id, event_type, event_data)
+                    SELECT id, 'OrderStatusChanged', %s::jsonb FROM updated_order
+                """, (
+                    new_status,
+                    order_id,
+                    saga_step,
+                    completed_steps or [],
+                    compensation_needed,
+                    json.dumps(event_data)
+                ))
+                
+                if cursor.rowcount == 0:
+                    return False
+                
+                if self.log_info:
+                    self.logger.info(
+                        "📤 OrderStatusChanged event added to outbox",
+                        order_id=order_id,
+                        new_status=new_status,
+                        reason=reason,
+                        outbox_event="Status change event queued for publishing"
+                    )
+        
+        # The cache is invalidated by the caller once its outermost transaction has committed
+        return True
     
     def get_timestamp(self) -> str:
         """Get current timestamp in ISO format"""
-        return datetime.now(timezone.utc).isoformat()
+        return iso_now_fast()
 
 
 # ========================================
 # Application Entry Point
 # ========================================
 
+def create_app():
+    """WSGI application factory used by gunicorn"""
+    service = OrderService()
+    service.logger.info("📦 Starting Order Service under gunicorn")
+    return service.app
+
+
 if __name__ == '__main__':
     try:
         # Create and run service
@@ -8,33 +8,82 @@ Implements reliable event publishing pattern
 
 import os
 import sys
-import json
 import time
+import select
 import signal
 from typing import List, Dict, Any
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 
 # Add shared module to path
 sys.path.insert(0, '/app/shared')
 
+import psycopg2
+import psycopg2.extensions
+
 from base_service import BaseService, retry_with_backoff
 
 
+# Kafka topic per outbox event type (unknown types go to order-events)
+EVENT_TOPICS = {
+    'OrderCreated': 'order-events',
+    'OrderStatusChanged': 'order-events',
+    'OrderCompleted': 'order-events',
+    'OrderCancelled': 'order-events'
+}
+
+# Channel notified by the outbox insert trigger
+OUTBOX_NOTIFY_CHANNEL = 'outbox_new'
+
+OUTBOX_MIGRATIONS = [
+    # Claims are leases: a claimed event is skipped by other processors until claimed_until passes
+    "ALTER TABLE orders.outbox_events ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMP",
+    # Partial indexes stay as small as the rows they serve: the unprocessed backlog
+    # for the claim query (ordered by id) and processed rows for cleanup
+    """CREATE INDEX IF NOT EXISTS idx_outbox_events_unprocessed
+       ON orders.outbox_events(id) WHERE processed = false""",
+    """CREATE INDEX IF NOT EXISTS idx_outbox_events_processed_at
+       ON orders.outbox_events(processed_at) WHERE processed = true""",
+    # Per-aggregate ordering check in the claim (older unprocessed event of the same aggregate)
+    """CREATE INDEX IF NOT EXISTS idx_outbox_events_unprocessed_aggregate
+       ON orders.outbox_events(aggregate_id, id) WHERE processed = false""",
+    # Wake up processors as soon as new events are committed
+    f"""CREATE OR REPLACE FUNCTION orders.notify_outbox_new() RETURNS TRIGGER AS $$
+        BEGIN
+            PERFORM pg_notify('{OUTBOX_NOTIFY_CHANNEL}', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE TRIGGER outbox_events_notify
+       AFTER INSERT ON orders.outbox_events
+       FOR EACH STATEMENT EXECUTE FUNCTION orders.notify_outbox_new()""",
+]
+
+
 class OutboxProcessor:
     """Processes outbox events and publishes them to Kafka"""
     
     def __init__(self):
         # Initialize base service components
         self.service = BaseService('order-outbox-processor')
-        self.logger = self.service.logger
+        
+        # Several processors may run side by side; tag their logs to tell them apart
+        self.processor_id = os.getenv('PROCESSOR_ID', os.getenv('HOSTNAME', 'outbox-processor'))
+        self.logger = self.service.logger.bind(processor_id=self.processor_id)
         self.db = self.service.db
         self.events = self.service.events
         self.metrics = self.service.metrics
+        self.log_info = self.service.log_info
         
         # Processing configuration
         self.processing_interval = int(os.getenv('PROCESSING_INTERVAL', '5'))  # seconds
-        self.batch_size = int(os.getenv('BATCH_SIZE', '10'))
+        self.listen_timeout = int(os.getenv('LISTEN_TIMEOUT', '30'))  # seconds, max fallback poll
+        self.batch_size = int(os.getenv('BATCH_SIZE', '500'))
+        self.max_batch_bytes = int(os.getenv('MAX_BYTES_PER_BATCH', str(16 * 1024 * 1024)))
+        self.backlog_pending = False
         self.max_retries = int(os.getenv('MAX_RETRIES', '3'))
+        # Must outlast a full publish round (MAX_RETRIES x flush timeout + backoff); an expired lease
+        # lets another processor re-send the event (at-least-once, order kept per aggregate)
+        self.claim_lease_seconds = int(os.getenv('CLAIM_LEASE_SECONDS', '300'))
         
         # Graceful shutdown handling
         self.running = True
@@ -42,12 +91,17 @@ class OutboxProcessor:
         signal.signal(signal.SIGINT, self.signal_handler)
         
         # Initialize database
-        self.service.init_database_with_schema_creation('orders', 'SELECT COUNT(*) FROM orders.outbox_events WHERE processed = false')
+        self.service.init_database_with_schema_creation(
+            'orders',
+            'SELECT COUNT(*) FROM orders.outbox_events WHERE processed = false',
+            migrations=OUTBOX_MIGRATIONS
+        )
+        
+        # Dedicated connection for LISTEN, opened lazily
+        self.listen_connection = None
         
         self.logger.info("Outbox Processor initialized")
     
-
-    
     def signal_handler(self, signum, frame):
         """Handle graceful shutdown signals"""
         self.logger.info("Received shutdown signal", signal=signum)
@@ -57,6 +111,9 @@ class OutboxProcessor:
         """Main processing loop"""
         self.logger.info("🚀 Starting Outbox Processor")
         
+        # Fallback poll interval: doubles while idle, resets once events show up
+        idle_timeout = self.processing_interval
+        
         while self.running:
             try:
                 processed_count = self.process_batch()
@@ -64,8 +121,20 @@ class OutboxProcessor:
                 if processed_count > 0:
                     self.logger.info("Processed outbox events", count=processed_count)
                 
-                # Sleep between processing cycles
-                time.sleep(self.processing_interval)
+                if processed_count > 0 and self.backlog_pending:
+                    # Batch was cut by BATCH_SIZE, MAX_BYTES_PER_BATCH or the one-event-per-aggregate rule;
+                    # claim the next one right away
+                    idle_timeout = self.processing_interval
+                    continue
+                
+                if processed_count == 0:
+                    timeout = idle_timeout
+                    idle_timeout = min(idle_timeout * 2, self.listen_timeout)
+                else:
+                    timeout = idle_timeout = self.processing_interval
+                
+                # Sleep until new events are inserted (or the fallback timeout expires)
+                self.wait_for_new_events(timeout)
                 
             except Exception as e:
                 self.logger.error("Processing cycle failed", error=str(e))
@@ -73,107 +142,199 @@ class OutboxProcessor:
         
         self.logger.info("Outbox Processor stopped")
     
+    def open_listen_connection(self):
+        """Open an autocommit connection subscribed to outbox insert notifications"""
+        try:
+            connection = psycopg2.connect(self.service.config.DATABASE_URL)
+            connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {OUTBOX_NOTIFY_CHANNEL}")
+            
+            self.logger.info("Listening for outbox notifications", channel=OUTBOX_NOTIFY_CHANNEL)
+            return connection
+        except Exception as e:
+            self.logger.warning("Failed to open LISTEN connection, falling back to polling", error=str(e))
+            return None
+    
+    def wait_for_new_events(self, timeout: float):
+        """Block until an outbox insert is notified or the timeout expires"""
+        if self.listen_connection is None or self.listen_connection.closed:
+            self.listen_connection = self.open_listen_connection()
+        
+        if self.listen_connection is None:
+            time.sleep(timeout)
+            return
+        
+        try:
+            # Notifications that arrived while processing make select return immediately
+            readable, _, _ = select.select([self.listen_connection], [], [], timeout)
+            if readable:
+                self.listen_connection.poll()
+                self.listen_connection.notifies.clear()
+        except Exception as e:
+            self.logger.warning("LISTEN connection failed", error=str(e))
+            self.listen_connection.close()
+            self.listen_connection = None
+            time.sleep(self.processing_interval)
+    
     def process_batch(self) -> int:
         """Process a batch of unprocessed outbox events"""
         try:
-            # Get unprocessed events
-            unprocessed_events = self.get_unprocessed_events(self.batch_size)
+            # The claim commits right away: rows are leased (claimed_until), not locked, while Kafka is called
+            with self.db.transaction():
+                claimed_events = self.claim_unprocessed_events(self.batch_size)
             
-            if not unprocessed_events:
+            if not claimed_events:
                 return 0
             
-            processed_count = 0
+            successful_ids = self.publish_events(claimed_events)
             
-            for event in unprocessed_events:
-                try:
-                    if self.process_single_event(event):
-                        processed_count += 1
-                    
-                    if not self.running:
-                        break
-                        
-                except Exception as e:
-                    self.logger.error(
-                        "Failed to process single event",
-                        event_id=event['id'],
-                        error=str(e)
-                    )
+            # Outcome in one short transaction: published events are done, failed ones are unleased for retry
+            successful = set(successful_ids)
+            with self.db.transaction():
+                self.mark_events_published(successful_ids)
+                self.release_events([event['id'] for event in claimed_events if event['id'] not in successful])
             
-            return processed_count
+            return len(successful_ids)
             
         except Exception as e:
             self.logger.error("Failed to process batch", error=str(e))
             return 0
     
-    def get_unprocessed_events(self, limit: int) -> List[Dict[str, Any]]:
-        """Get unprocessed events from outbox table"""
+    def claim_unprocessed_events(self, limit: int) -> List[Dict[str, Any]]:
+        """Lease unprocessed events in one statement (must run inside a transaction)"""
         try:
-            return self.db.execute_query("""
-                SELECT id, aggregate_id, event_type, event_data, created_at
-                FROM orders.outbox_events
-                WHERE processed = false
-                ORDER BY created_at ASC
-                LIMIT %s
-            """, (limit,), fetch=True)
+            # FOR UPDATE cannot be combined with window functions, so rows are locked first
+            # and the byte budget is applied on top (the first event is always taken).
+            # Only the oldest unprocessed event of each aggregate is claimable, so a processor can never
+            # publish an event while an older one of the same order is leased (or being retried) elsewhere
+            events = self.db.execute_query("""
+                WITH locked AS (
+                    SELECT id, octet_length(event_data::text) AS size_bytes
+                    FROM orders.outbox_events o
+                    WHERE processed = false
+                      AND (claimed_until IS NULL OR claimed_until < CURRENT_TIMESTAMP)
+                      AND NOT EXISTS (
+                          SELECT 1 FROM orders.outbox_events p
+                          WHERE p.aggregate_id = o.aggregate_id AND p.processed = false AND p.id < o.id
+                      )
+                    ORDER BY id ASC
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                ), claimed AS (
+                    SELECT id, size_bytes
+                    FROM (
+                        SELECT id, size_bytes,
+                               SUM(size_bytes) OVER (ORDER BY id) AS running_bytes
+                        FROM locked
+                    ) budget
+                    WHERE running_bytes - size_bytes < %s
+                )
+                UPDATE orders.outbox_events o
+                SET claimed_until = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                FROM claimed
+                WHERE o.id = claimed.id
+                RETURNING o.id, o.aggregate_id, o.event_type, o.event_data::text AS event_data_text,
+                          claimed.size_bytes, o.created_at
+            """, (limit, self.max_batch_bytes, self.claim_lease_seconds), fetch=True)
+            
+            # Later events of the claimed aggregates only become claimable once these are published,
+            # so after any claim the next round may find more work
+            self.backlog_pending = bool(events)
+            
+            # RETURNING does not preserve the subquery order
+            return sorted(events, key=lambda event: event['id'])
         except Exception as e:
             self.logger.error("Failed to get unprocessed events", error=str(e))
             return []
     
-    def process_single_event(self, event: Dict[str, Any]) -> bool:
-        """Process a single outbox event"""
+    def publish_events(self, events: List[Dict[str, Any]]) -> List[int]:
+        """Publish events asynchronously with one flush per round; returns IDs confirmed by Kafka"""
+        successful_ids = []
+        pending = list(events)
+        
+        def publish_pending():
+            nonlocal pending
+            
+            inflight = []
+            for event in pending:
+                inflight.append((event, self.process_single_event(event)))
+                
+                if not self.running:
+                    break
+            
+            # Wait for the whole batch once instead of once per event
+            self.events.flush(timeout=30)
+            
+            # Events of one aggregate must stay ordered: once one of them fails,
+            # the ones after it are re-sent with it, even if they were delivered
+            failed = []
+            blocked_aggregates = set()
+            for event, future in inflight:
+                delivered = future is not None and future.is_done and future.succeeded()
+                if delivered and event['aggregate_id'] not in blocked_aggregates:
+                    successful_ids.append(event['id'])
+                    
+                    if self.log_info:
+                        self.logger.info(
+                            "Event published successfully",
+                            event_id=event['id'],
+                            event_type=event['event_type'],
+                            aggregate_id=event['aggregate_id']
+                        )
+                    self.metrics.record_business_event('outbox_event_processed', 'success')
+                else:
+                    blocked_aggregates.add(event['aggregate_id'])
+                    failed.append(event)
+            
+            pending = failed
+            if pending and self.running:
+                raise Exception(f"{len(pending)} events were not confirmed by Kafka")
+        
+        try:
+            # Only events that failed in the previous round are re-sent
+            retry_with_backoff(
+                publish_pending,
+                max_attempts=self.max_retries,
+                base_delay=1.0,
+                max_delay=30.0
+            )
+        except Exception as e:
+            self.logger.warning("Event publishing failed", error=str(e))
+        
+        for event in pending:
+            self.logger.error(
+                "Failed to publish event after retries",
+                event_id=event['id'],
+                event_type=event['event_type']
+            )
+            self.metrics.record_business_event('outbox_event_processed', 'failed')
+        
+        return successful_ids
+    
+    def process_single_event(self, event: Dict[str, Any]):
+        """Queue a single outbox event on the Kafka producer; returns its send future"""
         event_id = event['id']
         event_type = event['event_type']
         aggregate_id = event['aggregate_id']
         
         try:
-            # Parse event data
-            event_data = json.loads(event['event_data']) if isinstance(event['event_data'], str) else event['event_data']
-            
-            # Проверяем размер данных события из базы
-            raw_event_size = len(str(event['event_data']).encode('utf-8'))
-            self.logger.info(
+            # Размер события считает база (size_bytes), без копирования payload
+            self.logger.debug(
                 "Processing outbox event",
                 event_id=event_id,
                 event_type=event_type,
                 aggregate_id=aggregate_id,
-                raw_event_size_bytes=raw_event_size,
-                raw_event_size_mb=round(raw_event_size / 1024 / 1024, 2)
+                raw_event_size_bytes=event.get('size_bytes')
             )
             
             # Determine target topic based on event type
             topic = self.get_topic_for_event_type(event_type)
             
-            # Publish event to Kafka with retry
-            success = retry_with_backoff(
-                lambda: self.publish_event_with_confirmation(topic, event_data, aggregate_id),
-                max_attempts=self.max_retries,
-                base_delay=1.0,
-                max_delay=30.0
+            # Payload is forwarded as stored, without a JSON parse/serialize round-trip
+            return self.events.send_raw_event(
+                topic, event['event_data_text'].encode('utf-8'), aggregate_id, event_type=event_type
             )
-            
-            if success:
-                # Mark event as processed
-                self.mark_event_processed(event_id)
-                
-                self.logger.info(
-                    "Event published successfully",
-                    event_id=event_id,
-                    event_type=event_type,
-                    aggregate_id=aggregate_id,
-                    topic=topic
-                )
-                
-                self.metrics.record_business_event('outbox_event_processed', 'success')
-                return True
-            else:
-                self.logger.error(
-                    "Failed to publish event after retries",
-                    event_id=event_id,
-                    event_type=event_type
-                )
-                
-                self.metrics.record_business_event('outbox_event_processed', 'failed')
-                return False
                 
         except Exception as e:
             self.logger.error(
@@ -181,49 +342,46 @@ class OutboxProcessor:
                 event_id=event_id,
                 error=str(e)
             )
-            return False
+            return None
     
     def get_topic_for_event_type(self, event_type: str) -> str:
         """Determine Kafka topic based on event type"""
-        topic_mapping = {
-            'OrderCreated': 'order-events',
-            'OrderStatusChanged': 'order-events',
-            'OrderCompleted': 'order-events',
-            'OrderCancelled': 'order-events'
-        }
-        
-        return topic_mapping.get(event_type, 'order-events')
+        return EVENT_TOPICS.get(event_type, 'order-events')
     
-    def publish_event_with_confirmation(self, topic: str, event_data: Dict[str, Any], key: str) -> bool:
-        """Publish event to Kafka and confirm delivery"""
-        try:
-            success = self.events.publish_event(topic, event_data, key)
-            
-            if not success:
-                raise Exception("Failed to publish event to Kafka")
-            
-            return True
-            
-        except Exception as e:
-            self.logger.warning("Event publishing failed", topic=topic, error=str(e))
-            raise
+    def mark_events_published(self, event_ids: List[int]):
+        """Mark events confirmed by Kafka as processed and drop their lease"""
+        if not event_ids:
+            return
+        
+        with self.db.get_cursor() as cursor:
+            cursor.execute("""
+                UPDATE orders.outbox_events
+                SET processed = true, processed_at = CURRENT_TIMESTAMP, claimed_until = NULL
+                WHERE id = ANY(%s)
+            """, (event_ids,))
     
-    def mark_event_processed(self, event_id: int):
-        """Mark event as processed in outbox table"""
+    def release_events(self, event_ids: List[int]):
+        """Drop the lease of claimed events that failed to publish, so the next round retries them"""
+        if not event_ids:
+            return
+        
         try:
-            with self.db.transaction():
-                with self.db.get_cursor() as cursor:
-                    cursor.execute("""
-                        UPDATE orders.outbox_events
-                        SET processed = true, processed_at = CURRENT_TIMESTAMP
-                        WHERE id = %s
-                    """, (event_id,))
-                    
-                    if cursor.rowcount == 0:
-                        raise Exception(f"Event {event_id} not found for marking as processed")
+            with self.db.get_cursor() as cursor:
+                cursor.execute("""
+                    UPDATE orders.outbox_events
+                    SET claimed_until = NULL
+                    WHERE id = ANY(%s) AND processed = false
+                """, (event_ids,))
+                
+                if cursor.rowcount != len(event_ids):
+                    self.logger.warning(
+                        "Some events not found for releasing",
+                        expected=len(event_ids),
+                        updated=cursor.rowcount
+                    )
                         
         except Exception as e:
-            self.logger.error("Failed to mark event as processed", event_id=event_id, error=str(e))
+            self.logger.error("Failed to release events", event_ids=event_ids, error=str(e))
             raise
     
     def get_processing_stats(self) -> Dict[str, Any]:
@@ -245,16 +403,30 @@ class OutboxProcessor:
             self.logger.error("Failed to get processing stats", error=str(e))
             return {}
     
-    def cleanup_processed_events(self, retention_hours: int = 24):
-        """Delete processed events older than the retention period."""
+    def cleanup_processed_events(self, retention_hours: int = 24, chunk_size: int = 5000):
+        """Delete processed events older than the retention period in short per-chunk transactions."""
+        cutoff = datetime.now(timezone.utc) - timedelta(hours=retention_hours)
+        deleted_count = 0
+        
         try:
-            with self.db.transaction():
-                with self.db.get_cursor() as cursor:
-                    cursor.execute("""
-                        DELETE FROM orders.outbox_events
-                        WHERE processed = true AND processed_at < NOW() - INTERVAL '%s hours'
-                    """, (retention_hours,))
-                    self.logger.info("Cleaned up old processed events", deleted_count=cursor.rowcount)
+            while self.running:
+                with self.db.transaction():
+                    with self.db.get_cursor() as cursor:
+                        cursor.execute("""
+                            DELETE FROM orders.outbox_events
+                            WHERE id = ANY(ARRAY(
+                                SELECT id FROM orders.outbox_events
+                                WHERE processed = true AND processed_at < %s
+                                LIMIT %s
+                            ))
+                        """, (cutoff, chunk_size))
+                        chunk_deleted = cursor.rowcount
+                
+                deleted_count += chunk_deleted
+                if chunk_deleted < chunk_size:
+                    break
+            
+            self.logger.info("Cleaned up old processed events", deleted_count=deleted_count)
         except Exception as e:
             self.logger.error("Failed to cleanup processed events", error=str(e))
 
@@ -10,15 +10,27 @@ import sys
 import json
 import random
 import time
+import threading
+from collections import OrderedDict
 from typing import Dict, List, Any
 from flask import request, jsonify
 from flask_cors import CORS
-from datetime import datetime, timezone
 
 # Add shared module to path
 sys.path.insert(0, '/app/shared')
 
-from base_service import BaseService, generate_id, validate_required_fields, ValidationError
+from base_service import BaseService, generate_id, iso_now_fast, validate_required_fields, ValidationError
+
+# Simulated decline reasons
+FAILURE_REASONS = (
+    "Insufficient funds",
+    "Card declined by bank",
+    "Security validation failed",
+    "Transaction limit exceeded"
+)
+
+# Number of request outcomes remembered for deduplicating repeated (hedged) requests
+DEDUP_CAPACITY = 10000
 
 class PaymentMockService(BaseService):
     """Mock payment provider service for testing"""
@@ -31,6 +43,11 @@ class PaymentMockService(BaseService):
         self.failure_rate = float(os.environ.get('FAILURE_RATE', '0.1'))
         self.delay_ms = int(os.environ.get('DELAY_MS', '100'))
         
+        # Idempotency-Key -> response, so a repeated (hedged) request gets the same answer.
+        # Kept in process memory: the service must run as a single gunicorn worker (WEB_CONCURRENCY=1)
+        self._outcomes = OrderedDict()
+        self._outcomes_lock = threading.Lock()
+        
         # Setup Flask routes
         self.setup_routes()
 
@@ -38,49 +55,70 @@ class PaymentMockService(BaseService):
 
     def setup_routes(self):
         """Setup API routes for the mock service."""
+        # Dedicated generator bound once instead of module-level random lookups per request
+        rng = random.Random()
+        rnd = rng.random
+        choice = rng.choice
         
-        @self.app.route('/api/v1/payments/process', methods=['POST'])
-        def process_payment():
-            """Simulate processing a payment."""
-            # Simulate network delay
-            time.sleep(self.delay_ms / 1000.0)
-
-            # Simulate payment failure
-            if random.random() < self.failure_rate:
-                failure_reason = random.choice([
-                    "Insufficient funds",
-                    "Card declined by bank",
-                    "Security validation failed",
-                    "Transaction limit exceeded"
-                ])
+        def decide_outcome() -> tuple:
+            """Roll a simulated outcome"""
+            if rnd() < self.failure_rate:
+                failure_reason = choice(FAILURE_REASONS)
                 self.logger.warning("Payment processing failed (simulated)", reason=failure_reason)
-                return jsonify({
+                return {
                     'success': False,
                     'transactionId': generate_id('txn_fail_'),
                     'failureReason': failure_reason,
                     'timestamp': self.get_timestamp()
-                }), 400
+                }, 400
 
-            # Simulate successful payment
             transaction_id = generate_id('txn_succ_')
             self.logger.info("Payment processing successful (simulated)", transaction_id=transaction_id)
-            return jsonify({
+            return {
                 'success': True,
                 'transactionId': transaction_id,
                 'message': 'Payment processed successfully',
                 'timestamp': self.get_timestamp()
-            }), 200
+            }, 200
+        
+        @self.app.route('/api/v1/payments/process', methods=['POST'])
+        def process_payment():
+            """Simulate processing a payment."""
+            request_key = request.headers.get('Idempotency-Key')
+            
+            # Outcome is fixed on first sight of a key, so duplicate requests are no-ops
+            with self._outcomes_lock:
+                outcome = self._outcomes.get(request_key) if request_key else None
+                if outcome is None:
+                    outcome = decide_outcome()
+                    if request_key:
+                        self._outcomes[request_key] = outcome
+                        if len(self._outcomes) > DEDUP_CAPACITY:
+                            self._outcomes.popitem(last=False)
+                else:
+                    self.logger.info("Duplicate payment request, returning original outcome", request_key=request_key)
+            
+            # Simulate network delay
+            time.sleep(self.delay_ms / 1000.0)
+            
+            body, status_code = outcome
+            return jsonify(body), status_code
 
     def get_timestamp(self) -> str:
         """Get current timestamp in ISO 8601 format."""
-        return datetime.now(timezone.utc).isoformat()
+        return iso_now_fast()
 
 # ========================================
 # SERVICE STARTUP
 # ========================================
+def create_app():
+    """WSGI application factory used by gunicorn"""
+    service = PaymentMockService()
+    return service.app
+
+
 if __name__ == '__main__':
     service = PaymentMockService()
     
-    # Use Gunicorn for production. For simplicity, we run the Flask dev server.
-    # In a real setup, you'd have a separate entrypoint script that runs Gunicorn.
+    # Local development only; the container runs create_app() under gunicorn
     service.app.run(host='0.0.0.0', port=5003, debug=False) 
\ No newline at end of file
@@ -10,18 +10,129 @@ import sys
 import json
 import threading
 import time
-import hashlib
-from typing import Dict, List, Any, Optional
+import random
+from hashlib import blake2b
+import heapq
+import itertools
+from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, List, Any, Optional, Tuple
 from flask import request, jsonify
 from flask_cors import CORS
-from datetime import datetime, timezone, timedelta
 from enum import Enum
-import requests
+import orjson
+import urllib3
+from cachetools import TTLCache
 
 # Add shared module to path
 sys.path.insert(0, '/app/shared')
 
-from base_service import BaseService, generate_id, validate_required_fields, ValidationError, retry_with_backoff
+from base_service import BaseService, generate_id, iso_now_fast, event_preview, validate_required_fields, ValidationError, retry_with_backoff
+
+
+PAYMENT_MIGRATIONS = [
+    # Databases from before the unique index may hold duplicate attempt numbers, which would fail the
+    # index build (and roll back the whole init) on every start. Renumber those payments' attempts in
+    # their existing order first; skipped once the index exists, since duplicates are impossible then.
+    """DO $$
+       BEGIN
+           IF to_regclass('payments.idx_payment_attempts_payment_attempt') IS NULL THEN
+               UPDATE payments.payment_attempts a
+               SET attempt_number = r.rn
+               FROM (
+                   SELECT id, ROW_NUMBER() OVER (PARTITION BY payment_id ORDER BY attempt_number, id) AS rn
+                   FROM payments.payment_attempts
+                   WHERE payment_id IN (
+                       SELECT payment_id FROM payments.payment_attempts
+                       GROUP BY payment_id, attempt_number HAVING COUNT(*) > 1
+                   )
+               ) r
+               WHERE a.id = r.id AND a.attempt_number <> r.rn;
+           END IF;
+       END $$""",
+    # Attempt numbers come from the retry loop; a racing duplicate must collide, not slip in
+    """CREATE UNIQUE INDEX IF NOT EXISTS idx_payment_attempts_payment_attempt
+       ON payments.payment_attempts(payment_id, attempt_number)""",
+    # Superseded by the composite index above (same leading column); one less index to write per attempt
+    "DROP INDEX IF EXISTS payments.idx_payment_attempts_payment_id",
+]
+
+
+# ========================================
+# SQL Statements
+# ========================================
+# Hot-path statements, run as server-side prepared statements (named at the call site)
+
+SQL_INSERT_PAYMENT = """
+    INSERT INTO payments.payments (id, order_id, amount, payment_method, status, idempotency_key)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    ON CONFLICT DO NOTHING
+    RETURNING *
+"""
+
+# Same insert, also reading the order's delivery address in the same round-trip; the crash test itself
+# is decided in Python by is_crash_test_address, so both paths agree on what counts as whitespace.
+SQL_INSERT_PAYMENT_CHECK_CRASH_TEST = """
+    WITH inserted AS (
+        INSERT INTO payments.payments (id, order_id, amount, payment_method, status, idempotency_key)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT DO NOTHING
+        RETURNING *
+    )
+    SELECT inserted.*, o.delivery_address AS order_delivery_address
+    FROM inserted
+    LEFT JOIN orders.orders o ON o.id = inserted.order_id
+"""
+
+SQL_GET_EXISTING_PAYMENT = "SELECT * FROM payments.payments WHERE order_id = %s OR idempotency_key = %s LIMIT 1"
+
+SQL_INSERT_ATTEMPT = """
+    INSERT INTO payments.payment_attempts
+        (payment_id, attempt_number, status, error_message, completed_at)
+    VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP)
+    RETURNING id
+"""
+
+_SQL_GET_PAYMENT_WITH_ATTEMPTS = """
+    SELECT p.*,
+           COALESCE(json_agg(a ORDER BY a.attempt_number) FILTER (WHERE a.id IS NOT NULL), '[]')::text
+               AS attempts_json
+    FROM payments.payments p
+    LEFT JOIN payments.payment_attempts a ON a.payment_id = p.id
+    WHERE p.{column} = %s
+    GROUP BY p.id
+"""
+
+# Keyed by lookup column
+SQL_GET_PAYMENT_WITH_ATTEMPTS = {
+    column: _SQL_GET_PAYMENT_WITH_ATTEMPTS.format(column=column) for column in ('id', 'order_id')
+}
+
+SQL_MARK_PROCESSING = """
+    UPDATE payments.payments
+    SET status = %s, updated_at = CURRENT_TIMESTAMP
+    WHERE id = %s AND status = %s
+"""
+
+SQL_UPDATE_STATUS = """
+    UPDATE payments.payments
+    SET status = %s, failure_reason = %s, updated_at = CURRENT_TIMESTAMP
+    WHERE id = %s
+"""
+
+
+# Provider request body with a fixed shape, filled in with bytes %-formatting instead of encoding a dict
+PROVIDER_PAYLOAD_TEMPLATE = b'{"order_id":%b,"amount":%d,"card_details":"...sensitive data..."}'
+
+
+# Orders delivered to exactly this address fail payment on purpose (saga compensation testing)
+CRASH_TEST_ADDRESS = '123'
+
+
+def is_crash_test_address(delivery_address: Any) -> bool:
+    """Check whether a delivery address triggers the crash test"""
+    return delivery_address is not None and str(delivery_address).strip() == CRASH_TEST_ADDRESS
 
 
 class PaymentStatus(Enum):
@@ -33,6 +144,19 @@ class PaymentStatus(Enum):
     CANCELLED = "CANCELLED"
 
 
+# Plain status strings for the hot path (avoids Enum attribute lookups per DB call)
+_PENDING = PaymentStatus.PENDING.value
+_PROCESSING = PaymentStatus.PROCESSING.value
+_COMPLETED = PaymentStatus.COMPLETED.value
+_FAILED = PaymentStatus.FAILED.value
+
+# Statuses that never change again (safe to cache for long)
+TERMINAL_PAYMENT_STATUSES = frozenset((_COMPLETED, _FAILED, PaymentStatus.CANCELLED.value))
+
+# Fields an OrderCreated event needs before a payment can be created from it
+_ORDER_CREATED_REQUIRED = frozenset(('totalAmount', 'paymentMethod', 'userId'))
+
+
 class CircuitBreakerState(Enum):
     """Circuit breaker state enumeration"""
     CLOSED = "CLOSED"
@@ -40,52 +164,163 @@ class CircuitBreakerState(Enum):
     HALF_OPEN = "HALF_OPEN"
 
 
+class CircuitOpenError(Exception):
+    """Raised when the circuit breaker refuses a provider call"""
+    pass
+
+
+class ProviderRejectedError(Exception):
+    """Raised inside the breaker guard when the provider answers with an error status"""
+    
+    def __init__(self, status: int, body: str):
+        super().__init__(f"Payment provider returned HTTP {status}")
+        self.status = status
+        self.body = body
+
+
 class CircuitBreaker:
-    """Circuit breaker implementation for payment provider"""
+    """Circuit breaker implementation for payment provider (shared by all payment worker threads)"""
     
-    def __init__(self, failure_threshold: int = 5, timeout: int = 60, success_threshold: int = 3):
+    def __init__(self, failure_threshold: int = 5, timeout: int = 60, success_threshold: int = 3,
+                 failure_window: int = 60):
         self.failure_threshold = failure_threshold
         self.timeout = timeout
         self.success_threshold = success_threshold
+        self.failure_window = failure_window
         
-        self.failure_count = 0
+        self._lock = threading.Lock()
+        # Monotonic timestamps of recent failures; only the last failure_window seconds count
+        self.failures = deque(maxlen=failure_threshold * 4)
         self.success_count = 0
-        self.last_failure_time = None
+        self.last_failure_time = None  # time.monotonic() of the last failure
+        self.open_timeout = timeout
         self.state = CircuitBreakerState.CLOSED
     
+    @property
+    def failure_count(self) -> int:
+        """Number of failures within the sliding window"""
+        with self._lock:
+            self._prune_failures(time.monotonic())
+            return len(self.failures)
+    
+    def _prune_failures(self, now: float):
+        """Drop failures that fell out of the sliding window (caller holds the lock)"""
+        while self.failures and self.failures[0] < now - self.failure_window:
+            self.failures.popleft()
+    
     def can_execute(self) -> bool:
         """Check if request can be executed"""
+        # Lock-free fast path: reading a single attribute is atomic
         if self.state == CircuitBreakerState.CLOSED:
             return True
-        elif self.state == CircuitBreakerState.OPEN:
-            if self.last_failure_time and \
-               datetime.now() > self.last_failure_time + timedelta(seconds=self.timeout):
-                self.state = CircuitBreakerState.HALF_OPEN
-                self.success_count = 0
-                return True
-            return False
-        elif self.state == CircuitBreakerState.HALF_OPEN:
-            return True
         
-        return False
+        with self._lock:
+            if self.state == CircuitBreakerState.OPEN:
+                if self.last_failure_time is not None and \
+                   time.monotonic() - self.last_failure_time > self.open_timeout:
+                    self.state = CircuitBreakerState.HALF_OPEN
+                    self.success_count = 0
+                    return True
+                return False
+            
+            return True
     
     def record_success(self):
         """Record successful execution"""
-        if self.state == CircuitBreakerState.HALF_OPEN:
-            self.success_count += 1
-            if self.success_count >= self.success_threshold:
-                self.state = CircuitBreakerState.CLOSED
-                self.failure_count = 0
-        else:
-            self.failure_count = 0
+        with self._lock:
+            if self.state == CircuitBreakerState.HALF_OPEN:
+                self.success_count += 1
+                if self.success_count >= self.success_threshold:
+                    self.state = CircuitBreakerState.CLOSED
+                    self.failures.clear()
     
     def record_failure(self):
-        """Record failed execution"""
-        self.failure_count += 1
-        self.last_failure_time = datetime.now()
-        
-        if self.failure_count >= self.failure_threshold:
-            self.state = CircuitBreakerState.OPEN
+        """Record failed execution; opens when failure_threshold failures fall within failure_window"""
+        with self._lock:
+            now = time.monotonic()
+            self.failures.append(now)
+            self._prune_failures(now)
+            self.last_failure_time = now
+            
+            # A failed probe in HALF_OPEN reopens immediately
+            tripped = len(self.failures) >= self.failure_threshold or self.state == CircuitBreakerState.HALF_OPEN
+            if tripped and self.state != CircuitBreakerState.OPEN:
+                self.state = CircuitBreakerState.OPEN
+                # Jitter keeps replicas from probing the provider at the same moment
+                self.open_timeout = self.timeout + random.uniform(0, self.timeout * 0.1)
+    
+    @contextmanager
+    def guard(self):
+        """Run one protected call: refuse it when open, otherwise record its outcome exactly once"""
+        if not self.can_execute():
+            raise CircuitOpenError("Payment provider is unavailable (circuit breaker OPEN)")
+        try:
+            yield
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """Consistent view of the breaker for status endpoints (read-only: never moves OPEN to HALF_OPEN)"""
+        with self._lock:
+            now = time.monotonic()
+            self._prune_failures(now)
+            can_execute = self.state != CircuitBreakerState.OPEN or (
+                self.last_failure_time is not None and now - self.last_failure_time > self.open_timeout
+            )
+            return {
+                'state': self.state.value,
+                'failureCount': len(self.failures),
+                'successCount': self.success_count,
+                'canExecute': can_execute
+            }
+    
+    def reset(self):
+        """Reset circuit breaker to CLOSED state"""
+        with self._lock:
+            self.state = CircuitBreakerState.CLOSED
+            self.failures.clear()
+            self.success_count = 0
+            self.last_failure_time = None
+
+
+class DelayedCallScheduler:
+    """Runs callbacks after a delay on one shared thread (instead of a threading.Timer thread per call)"""
+    
+    def __init__(self, name: str, logger):
+        self.logger = logger
+        self._queue = []  # heap of [due, seq, func, args, cancelled]
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        threading.Thread(target=self._run, name=name, daemon=True).start()
+    
+    def schedule(self, delay: float, func: Callable, *args) -> list:
+        """Run func(*args) after delay seconds; returns a handle for cancel()"""
+        entry = [time.monotonic() + delay, next(self._sequence), func, args, False]
+        with self._condition:
+            heapq.heappush(self._queue, entry)
+            if self._queue[0] is entry:
+                self._condition.notify()
+        return entry
+    
+    def cancel(self, entry: list):
+        """Skip a scheduled call (no-op if it already ran)"""
+        entry[4] = True
+    
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue or self._queue[0][0] > time.monotonic():
+                    timeout = self._queue[0][0] - time.monotonic() if self._queue else None
+                    self._condition.wait(timeout)
+                _, _, func, args, cancelled = heapq.heappop(self._queue)
+            if not cancelled:
+                # One failing callback must not stop the scheduler, but it must not vanish either
+                try:
+                    func(*args)
+                except Exception:
+                    self.logger.exception("Delayed call failed", func=getattr(func, '__name__', repr(func)))
 
 
 class PaymentService(BaseService):
@@ -101,23 +336,74 @@ class PaymentService(BaseService):
         self.max_retry_attempts = int(os.getenv('PAYMENT_MAX_RETRIES', '3'))
         self.retry_delay_base = float(os.getenv('PAYMENT_RETRY_DELAY', '2.0'))
         self.payment_timeout = int(os.getenv('PAYMENT_TIMEOUT', '30'))
+        self.slow_threshold = float(os.getenv('PAYMENT_SLOW_MS', '500')) / 1000
+        self.slow_payment_scheduler = DelayedCallScheduler('pay-slow-marker', self.logger)
+        # The "123" delivery address crash test can be switched off entirely (skips its order lookups)
+        self.crash_test_enabled = os.getenv('ENABLE_CRASH_TEST', 'true').lower() == 'true'
+        self.payment_mock_url = f"{os.getenv('PAYMENT_MOCK_URL', 'http://payment-mock:5003')}/api/v1/payments/process"
+        
+        # Bounded pool for async payment processing (caps concurrent provider calls)
+        payment_workers = int(os.getenv('PAYMENT_WORKERS', '8'))
+        self.payment_executor = ThreadPoolExecutor(
+            max_workers=payment_workers,
+            thread_name_prefix='pay'
+        )
+        
+        # In-process cache for payment reads. Only terminal rows are cached: they no longer change, so a
+        # copy held by another gunicorn worker (invalidation is local to each worker) cannot go stale
+        self.payment_cache_terminal_ttl = float(os.getenv('PAYMENT_CACHE_TERMINAL_TTL', '300'))
+        self._payment_cache = TTLCache(maxsize=10000, ttl=self.payment_cache_terminal_ttl)
+        self._payment_cache_lock = threading.Lock()
+        
+        # Orders whose OrderCreated was already handled; redeliveries skip the DB (consumer thread only)
+        self._recent_orders = TTLCache(maxsize=10000, ttl=300)
+        
+        # Slots for running + queued payments: POSTs beyond PAYMENT_QUEUE_LIMIT queued get 429, the consumer
+        # waits for a slot but at most PAYMENT_CONSUMER_MAX_WAIT per batch (well under max.poll.interval.ms)
+        self.payment_queue_limit = int(os.getenv('PAYMENT_QUEUE_LIMIT', '1000'))
+        self.payment_slots = threading.BoundedSemaphore(payment_workers + self.payment_queue_limit)
+        self.consumer_slot_wait = float(os.getenv('PAYMENT_CONSUMER_MAX_WAIT', '60'))
+        
+        # Hedged provider calls: a backup request is sent if the first is slower than hedge_delay
+        self.hedge_delay = float(os.getenv('PAYMENT_HEDGE_DELAY_MS', '200')) / 1000
+        self.provider_capacity = payment_workers * 2
+        self.provider_executor = ThreadPoolExecutor(
+            max_workers=self.provider_capacity,
+            thread_name_prefix='pay-provider'
+        )
+        self._provider_in_flight = 0
+        self._provider_lock = threading.Lock()
+        
+        # Keep-alive connection pool for payment provider calls, used directly without the requests
+        # Session layers (retries are handled by retry_with_backoff)
+        self.http = urllib3.PoolManager(
+            num_pools=4,
+            maxsize=self.provider_capacity,
+            retries=False,
+            timeout=urllib3.Timeout(total=self.payment_timeout)
+        )
+        self.provider_headers = {'Content-Type': 'application/json'}
         
         # Circuit breaker for payment provider
         self.circuit_breaker = CircuitBreaker(
             failure_threshold=int(os.getenv('CB_FAILURE_THRESHOLD', '5')),
             timeout=int(os.getenv('CB_TIMEOUT', '60')),
-            success_threshold=int(os.getenv('CB_SUCCESS_THRESHOLD', '3'))
+            success_threshold=int(os.getenv('CB_SUCCESS_THRESHOLD', '3')),
+            failure_window=int(os.getenv('CB_FAILURE_WINDOW', '60'))
         )
         
         # Setup routes
         self.setup_routes()
         
         # Initialize database
-        self.init_database_with_schema_creation('payments', 'SELECT 1')
+        self.init_database_with_schema_creation('payments', 'SELECT 1', migrations=PAYMENT_MIGRATIONS)
         
         # Start event consumer in background thread
         self.start_event_consumer()
         
+        # Connect the producer in the background so the first payment event does not wait for it
+        threading.Thread(target=self.events.warm_up, args=(['payment-events'],), daemon=True).start()
+        
         self.logger.info("Payment Service initialized")
     
 
@@ -129,7 +415,13 @@ class PaymentService(BaseService):
         def process_payment():
             """Process payment with retry pattern and idempotency"""
             try:
-                data = request.get_json()
+                # Decode the raw body directly (skips Flask's content-type negotiation and body caching)
+                try:
+                    data = orjson.loads(request.get_data())
+                except orjson.JSONDecodeError:
+                    raise ValidationError("Request body must be valid JSON")
+                if not isinstance(data, dict):
+                    raise ValidationError("Request body must be a JSON object")
                 
                 # Validate required fields
                 required_fields = ['orderId', 'amount', 'paymentMethod']
@@ -146,36 +438,52 @@ class PaymentService(BaseService):
                 if amount <= 0:
                     raise ValidationError("Amount must be positive")
                 
-                # Check for existing payment (idempotency)
-                existing_payment = self.get_payment_by_order_id(order_id)
-                if existing_payment:
-                    self.logger.info("Payment already exists for order", order_id=order_id)
+                # Backpressure: refuse before writing anything if the worker queue is saturated
+                if not self.payment_slots.acquire(blocking=False):
+                    self.logger.warning("Payment queue saturated, rejecting payment", order_id=order_id)
+                    self.metrics.record_business_event('payment_started', 'rejected')
                     return jsonify({
-                        'success': True,
-                        'paymentId': existing_payment['id'],
-                        'status': existing_payment['status'],
-                        'message': 'Payment already processed'
-                    })
-                
-                # Generate payment ID and idempotency key
-                payment_id = generate_id('payment_')
-                idempotency_key = self.generate_idempotency_key(order_id, amount, payment_method)
-                
-                # Create payment record
-                payment_data = self.create_payment_record(
-                    payment_id=payment_id,
-                    order_id=order_id,
-                    amount=amount,
-                    payment_method=payment_method,
-                    idempotency_key=idempotency_key
-                )
+                        'success': False,
+                        'error': 'Payment service is busy, retry later'
+                    }), 429, {'Retry-After': '1'}
                 
-                # Process payment asynchronously
-                threading.Thread(
-                    target=self.process_payment_async,
-                    args=(payment_id,),
-                    daemon=True
-                ).start()
+                slot_held = True
+                try:
+                    # Generate payment ID; a client Idempotency-Key header takes precedence over the derived key
+                    payment_id = generate_id('payment_')
+                    idempotency_key = request.headers.get('Idempotency-Key') or \
+                        self.generate_idempotency_key(order_id, amount, payment_method)
+                    if len(idempotency_key) > 100:
+                        raise ValidationError("Idempotency-Key must be at most 100 characters")
+                    
+                    # Create payment record (idempotent: existing payment for the order is returned)
+                    payment, created = self.create_payment_record(
+                        payment_id=payment_id,
+                        order_id=order_id,
+                        amount=amount,
+                        payment_method=payment_method,
+                        idempotency_key=idempotency_key,
+                        check_crash_test=self.crash_test_enabled
+                    )
+                    
+                    if not created:
+                        self.logger.info("Payment already exists for order", order_id=order_id)
+                        return jsonify({
+                            'success': True,
+                            'paymentId': payment['id'],
+                            'status': payment['status'],
+                            'message': 'Payment already processed'
+                        })
+                    
+                    # Process payment asynchronously
+                    is_crash_test = payment.pop('is_crash_test', False)
+                    # The slot now belongs to submit_payment (released when processing ends)
+                    slot_held = False
+                    self.submit_payment(payment, is_crash_test)
+                    
+                finally:
+                    if slot_held:
+                        self.payment_slots.release()
                 
                 self.logger.info(
                     "Payment processing started",
@@ -215,7 +523,7 @@ class PaymentService(BaseService):
         def get_payment(payment_id: str):
             """Get payment details by ID"""
             try:
-                payment = self.get_payment_by_id(payment_id)
+                payment = self.get_payment_with_attempts(payment_id)
                 
                 if not payment:
                     return jsonify({
@@ -223,10 +531,6 @@ class PaymentService(BaseService):
                         'error': 'Payment not found'
                     }), 404
                 
-                # Get payment attempts
-                attempts = self.get_payment_attempts(payment_id)
-                payment['attempts'] = attempts
-                
                 self.logger.info("Payment retrieved", payment_id=payment_id)
                 
                 return jsonify({
@@ -247,7 +551,7 @@ class PaymentService(BaseService):
         def get_payment_by_order(order_id: str):
             """Get payment by order ID"""
             try:
-                payment = self.get_payment_by_order_id(order_id)
+                payment = self.get_payment_with_attempts(order_id, by_order=True)
                 
                 if not payment:
                     return jsonify({
@@ -255,10 +559,6 @@ class PaymentService(BaseService):
                         'error': 'Payment not found for order'
                     }), 404
                 
-                # Get payment attempts
-                attempts = self.get_payment_attempts(payment['id'])
-                payment['attempts'] = attempts
-                
                 return jsonify({
                     'success': True,
                     'payment': payment
@@ -278,12 +578,7 @@ class PaymentService(BaseService):
             try:
                 return jsonify({
                     'success': True,
-                    'circuitBreaker': {
-                        'state': self.circuit_breaker.state.value,
-                        'failureCount': self.circuit_breaker.failure_count,
-                        'successCount': self.circuit_breaker.success_count,
-                        'canExecute': self.circuit_breaker.can_execute()
-                    }
+                    'circuitBreaker': self.circuit_breaker.snapshot()
                 })
             except Exception as e:
                 self.logger.error("Failed to get circuit breaker status", error=str(e))
@@ -296,22 +591,14 @@ class PaymentService(BaseService):
         def reset_circuit_breaker():
             """Reset circuit breaker to CLOSED state"""
             try:
-                self.circuit_breaker.state = CircuitBreakerState.CLOSED
-                self.circuit_breaker.failure_count = 0
-                self.circuit_breaker.success_count = 0
-                self.circuit_breaker.last_failure_time = None
+                self.circuit_breaker.reset()
                 
                 self.logger.info("Circuit breaker reset to CLOSED state")
                 
                 return jsonify({
                     'success': True,
                     'message': 'Circuit breaker reset successfully',
-                    'circuitBreaker': {
-                        'state': self.circuit_breaker.state.value,
-                        'failureCount': self.circuit_breaker.failure_count,
-                        'successCount': self.circuit_breaker.success_count,
-                        'canExecute': self.circuit_breaker.can_execute()
-                    }
+                    'circuitBreaker': self.circuit_breaker.snapshot()
                 })
             except Exception as e:
                 self.logger.error("Failed to reset circuit breaker", error=str(e))
@@ -321,353 +608,396 @@ class PaymentService(BaseService):
                 }), 500
     
     def generate_idempotency_key(self, order_id: str, amount: int, payment_method: str) -> str:
-        """Generate idempotency key for payment"""
+        """Generate idempotency key for payment (128-bit BLAKE2b of the payment identity)"""
         data = f"{order_id}:{amount}:{payment_method}"
-        return hashlib.sha256(data.encode()).hexdigest()
+        return blake2b(data.encode(), digest_size=16).hexdigest()
     
     def create_payment_record(self, payment_id: str, order_id: str, amount: int,
-                            payment_method: str, idempotency_key: str) -> Dict:
-        """Create payment record in database"""
+                            payment_method: str, idempotency_key: str,
+                            check_crash_test: bool = False) -> Tuple[Dict, bool]:
+        """Create payment record in database; returns (payment row, created) - an existing payment for the order or key is returned as is
+        
+        With check_crash_test a new row also carries 'is_crash_test', read from the order in the same query.
+        """
+        params = (payment_id, order_id, amount, payment_method, _PENDING, idempotency_key)
         try:
+            # Atomic idempotency check: concurrent requests for one order (or one key) cannot both insert
             with self.db.transaction():
-                with self.db.get_cursor() as cursor:
-                    cursor.execute("""
-                        INSERT INTO payments (id, order_id, amount, payment_method, status, idempotency_key)
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                    """, (payment_id, order_id, amount, payment_method, PaymentStatus.PENDING.value, idempotency_key))
-                
+                if check_crash_test:
+                    payment = self.db.execute_query(
+                        SQL_INSERT_PAYMENT_CHECK_CRASH_TEST,
+                        params,
+                        fetch='one',
+                        prepared_name='pay_insert_check_crash_test'
+                    )
+                    if payment is not None:
+                        payment['is_crash_test'] = is_crash_test_address(payment.pop('order_delivery_address'))
+                else:
+                    payment = self.db.execute_query(
+                        SQL_INSERT_PAYMENT,
+                        params,
+                        fetch='one',
+                        prepared_name='pay_insert'
+                    )
+            
+            if payment is None:
+                return self.get_existing_payment(order_id, idempotency_key), False
+            
+            if self.log_info:
                 self.logger.info("Payment record created", payment_id=payment_id, order_id=order_id)
-                
-                return {
-                    'payment_id': payment_id,
-                    'order_id': order_id,
-                    'amount': amount,
-                    'status': PaymentStatus.PENDING.value
-                }
+            
+            return payment, True
                 
         except Exception as e:
             self.logger.error("Failed to create payment record", error=str(e))
             raise
     
-    def process_payment_async(self, payment_id: str):
-        """Process payment asynchronously with retry pattern"""
+    def submit_payment(self, payment: Dict, is_crash_test: bool, slot_held: bool = True):
+        """Queue payment processing; a held payment slot is released when processing ends"""
         try:
-            self.logger.info("🔄 Starting async payment processing", payment_id=payment_id)
-            
-            # Update status to PROCESSING
-            self.logger.info("📝 Updating payment status to PROCESSING", payment_id=payment_id)
-            self.update_payment_status(payment_id, PaymentStatus.PROCESSING.value)
+            future = self.payment_executor.submit(self.process_payment_async, payment, is_crash_test)
+        except Exception:
+            if slot_held:
+                self.payment_slots.release()
+            raise
+        if slot_held:
+            future.add_done_callback(lambda _: self.payment_slots.release())
+    
+    def process_payment_async(self, payment: Dict, is_crash_test: Optional[bool] = None):
+        """Process payment asynchronously with retry pattern (payment row is passed through, not re-read)"""
+        payment_id = payment['id']
+        
+        # Resolved once per payment instead of querying the order on every attempt
+        if not self.crash_test_enabled:
+            is_crash_test = False
+        elif is_crash_test is None:
+            is_crash_test = self.lookup_crash_test(payment_id, payment['order_id'])
+        
+        # PROCESSING is only written if the payment is still in flight after slow_threshold;
+        # fast payments go straight from PENDING to their terminal status
+        processing_timer = self.slow_payment_scheduler.schedule(self.slow_threshold, self.mark_payment_processing, payment)
+        
+        try:
+            self.logger.debug("Starting async payment processing", payment_id=payment_id)
             
-            # Process with retry pattern
-            self.logger.info("🔁 Starting retry pattern for payment", payment_id=payment_id)
-            success = retry_with_backoff(
-                lambda: self.attempt_payment_processing(payment_id),
-                max_attempts=self.max_retry_attempts,
-                base_delay=self.retry_delay_base,
-                max_delay=30.0
-            )
+            # Process with retry pattern (attempts are numbered from 1)
+            self.logger.debug("Starting retry pattern for payment", payment_id=payment_id)
+            attempt_numbers = itertools.count(1)
+            try:
+                success = retry_with_backoff(
+                    lambda: self.attempt_payment_processing(payment, next(attempt_numbers), is_crash_test),
+                    max_attempts=self.max_retry_attempts,
+                    base_delay=self.retry_delay_base,
+                    max_delay=30.0
+                )
+            finally:
+                self.slow_payment_scheduler.cancel(processing_timer)
             
-            self.logger.info(f"🎯 Retry pattern completed, success={success}", payment_id=payment_id)
+            self.logger.debug("Retry pattern completed", payment_id=payment_id, success=success)
             
             if success:
                 # Update status to COMPLETED
-                self.logger.info("✅ Payment succeeded, updating status to COMPLETED", payment_id=payment_id)
-                self.update_payment_status(payment_id, PaymentStatus.COMPLETED.value)
+                self.logger.debug("Payment succeeded, updating status to COMPLETED", payment_id=payment_id)
+                self.update_payment_status(payment, _COMPLETED)
                 
                 # Publish success event
-                self.logger.info("📤 Publishing payment success event", payment_id=payment_id)
-                self.publish_payment_success_event(payment_id)
+                self.logger.debug("Publishing payment success event", payment_id=payment_id)
+                self.publish_payment_success_event(payment)
                 
-                self.logger.info("🎉 Payment processing completed successfully", payment_id=payment_id)
+                if self.log_info:
+                    self.logger.info("Payment processing completed successfully", payment_id=payment_id)
                 self.metrics.record_business_event('payment_completed', 'success')
                 
             else:
                 # Update status to FAILED
-                self.logger.error("❌ Payment failed, updating status to FAILED", payment_id=payment_id)
-                self.update_payment_status(payment_id, PaymentStatus.FAILED.value, "Payment failed after retries")
+                self.logger.debug("Payment failed, updating status to FAILED", payment_id=payment_id)
+                failure_reason = "Payment failed after retries"
+                self.update_payment_status(payment, _FAILED, failure_reason)
                 
                 # Publish failure event
-                self.logger.info("📤 Publishing payment failure event", payment_id=payment_id)
-                self.publish_payment_failure_event(payment_id)
+                self.logger.debug("Publishing payment failure event", payment_id=payment_id)
+                self.publish_payment_failure_event(payment, failure_reason)
                 
-                self.logger.error("💥 Payment processing failed after retries", payment_id=payment_id)
+                self.logger.error("Payment processing failed after retries", payment_id=payment_id)
                 self.metrics.record_business_event('payment_completed', 'failed')
                 
         except Exception as e:
             self.logger.error("🚨 Payment async processing error", payment_id=payment_id, error=str(e), exc_info=True)
             
             # Update status to FAILED
-            self.update_payment_status(payment_id, PaymentStatus.FAILED.value, str(e))
+            self.update_payment_status(payment, _FAILED, str(e))
             
             # Publish failure event
-            self.publish_payment_failure_event(payment_id)
+            self.publish_payment_failure_event(payment, str(e))
     
-    def attempt_payment_processing(self, payment_id: str) -> bool:
+    def attempt_payment_processing(self, payment: Dict, attempt_number: int, is_crash_test: bool = False) -> bool:
         """Attempt to process payment (with circuit breaker)"""
+        payment_id = payment['id']
         try:
-            self.logger.info("🔍 Starting payment attempt", payment_id=payment_id)
-            
-            # Check circuit breaker
-            if not self.circuit_breaker.can_execute():
-                self.logger.warning("⚡ Circuit breaker is OPEN, payment blocked", payment_id=payment_id)
-                raise Exception("Payment provider is unavailable (circuit breaker OPEN)")
-            
-            self.logger.info("✅ Circuit breaker check passed", payment_id=payment_id)
-            
-            # Get payment details
-            self.logger.info("📋 Getting payment details", payment_id=payment_id)
-            payment = self.get_payment_by_id(payment_id)
-            if not payment:
-                raise Exception(f"Payment {payment_id} not found")
+            self.logger.debug("Starting payment attempt", payment_id=payment_id)
             
-            self.logger.info("✅ Payment details retrieved", payment_id=payment_id, order_id=payment.get('order_id'))
-            
-            # Record payment attempt
-            self.logger.info("📝 Recording payment attempt", payment_id=payment_id)
-            attempt_id = self.record_payment_attempt(payment_id)
-            self.logger.info("✅ Payment attempt recorded", payment_id=payment_id, attempt_id=attempt_id)
-            
-            # Call external payment provider (mocked)
-            self.logger.info("🌐 Calling payment provider", payment_id=payment_id)
-            success = self.call_payment_provider(payment)
-            self.logger.info(f"🎯 Payment provider call completed, success={success}", payment_id=payment_id)
+            # Call external payment provider (mocked); the breaker is checked and updated inside the call,
+            # and an open breaker raises before any attempt is recorded
+            self.logger.debug("Calling payment provider", payment_id=payment_id)
+            success = self.call_payment_provider_hedged(payment, is_crash_test, f"{payment_id}:{attempt_number}")
+            self.logger.debug("Payment provider call completed", payment_id=payment_id, success=success)
             
             if success:
                 # Record successful attempt
-                self.logger.info("✅ Recording successful attempt", payment_id=payment_id, attempt_id=attempt_id)
-                self.update_payment_attempt(attempt_id, success=True)
-                self.circuit_breaker.record_success()
+                self.logger.debug("Recording successful attempt", payment_id=payment_id, attempt_number=attempt_number)
+                self.record_payment_attempt(payment_id, attempt_number, success=True)
                 return True
             else:
-                # Check if this is a crash test (address = "123") to avoid affecting circuit breaker
-                is_crash_test = False
-                try:
-                    order = self.db.execute_query(
-                        "SELECT delivery_address FROM orders.orders WHERE id = %s",
-                        (payment.get('order_id'),),
-                        fetch='one'
-                    )
-                    if order:
-                        delivery_address_clean = str(order.get('delivery_address', '')).strip()
-                        is_crash_test = (delivery_address_clean == '123')
-                except Exception:
-                    pass
-                
                 # Record failed attempt
-                self.logger.warning("❌ Recording failed attempt", payment_id=payment_id, attempt_id=attempt_id)
-                self.update_payment_attempt(attempt_id, success=False, error="Payment provider rejected")
-                
-                # Only affect circuit breaker if it's not a crash test
-                if not is_crash_test:
-                    self.circuit_breaker.record_failure()
-                    self.logger.info("⚡ Circuit breaker failure recorded for real payment", payment_id=payment_id)
-                else:
-                    self.logger.info("🧪 Crash test failure - circuit breaker not affected", payment_id=payment_id)
-                
+                self.logger.debug("Recording failed attempt", payment_id=payment_id, attempt_number=attempt_number)
+                self.record_payment_attempt(payment_id, attempt_number, success=False, error="Payment provider rejected")
                 raise Exception("Payment provider rejected the transaction")
                 
         except Exception as e:
-            self.logger.warning("⚠️ Payment attempt failed", payment_id=payment_id, error=str(e), exc_info=True)
-            self.circuit_breaker.record_failure()
+            # Declines are expected here; no traceback formatting per failed attempt
+            self.logger.warning("Payment attempt failed", payment_id=payment_id, attempt_number=attempt_number, error=str(e))
             raise
     
-    def call_payment_provider(self, payment: Dict) -> bool:
-        """Call the external payment provider (mock)."""
-        payment_id = payment.get('id', 'unknown')
-        order_id = payment.get('order_id')
-        
-        # Check if delivery address is "123" - force failure for testing (but don't affect circuit breaker)
-        is_crash_test = False
+    def lookup_crash_test(self, payment_id: str, order_id: str) -> bool:
+        """Check the order's delivery address for the crash test (for payments not started from an event)"""
         try:
-            # Get order details to check delivery address
-            self.logger.info("🔍 Checking delivery address for order", payment_id=payment_id, order_id=order_id)
-            
             order = self.db.execute_query(
                 "SELECT delivery_address FROM orders.orders WHERE id = %s",
                 (order_id,),
-                fetch='one'
+                fetch='one',
+                prepared_name='pay_get_order_address'
             )
-            
-            if order:
-                delivery_address = order.get('delivery_address', '')
-                # Strip whitespace and convert to string for comparison
-                delivery_address_clean = str(delivery_address).strip()
-                
-                self.logger.info("📍 Found delivery address", 
-                               payment_id=payment_id, 
-                               order_id=order_id, 
-                               delivery_address=delivery_address,
-                               delivery_address_clean=delivery_address_clean,
-                               address_length=len(delivery_address_clean))
-                
-                # Check for EXACT match with "123" only
-                if delivery_address_clean == '123':
-                    self.logger.warning("🧪 CRASH TEST - Address is exactly '123', forcing payment failure", 
-                                      payment_id=payment_id, order_id=order_id)
-                    is_crash_test = True
-                else:
-                    self.logger.info("✅ Address is not exactly '123', proceeding with payment", 
-                                   payment_id=payment_id, 
-                                   delivery_address_clean=delivery_address_clean)
-            else:
-                self.logger.warning("⚠️ Order not found in database", payment_id=payment_id, order_id=order_id)
-                
         except Exception as e:
             self.logger.error("Failed to check delivery address", payment_id=payment_id, order_id=order_id, error=str(e))
+            return False
         
-        # If it's a crash test, return failure immediately without affecting circuit breaker
-        if is_crash_test:
+        if not order:
+            self.logger.warning("⚠️ Order not found in database", payment_id=payment_id, order_id=order_id)
             return False
         
-        # Circuit breaker check (only for real payments, not crash tests)
-        if not self.circuit_breaker.can_execute():
-            self.logger.warning("⚡ Circuit breaker is open. Skipping payment provider call.", payment_id=payment_id)
+        return is_crash_test_address(order.get('delivery_address'))
+    
+    def call_payment_provider_hedged(self, payment: Dict, is_crash_test: bool = False,
+                                     request_key: Optional[str] = None) -> bool:
+        """Call the payment provider, sending a backup request if the first one is slow (first success wins).
+        
+        The hedged pair is one logical attempt: the breaker records a single outcome for it.
+        """
+        if is_crash_test or self.hedge_delay <= 0:
+            return self.call_payment_provider(payment, is_crash_test, request_key)
+        return self.guarded_provider_call(payment, lambda: self.send_hedged_provider_request(payment, request_key))
+    
+    def send_hedged_provider_request(self, payment: Dict, request_key: Optional[str] = None):
+        """Send the provider request plus a backup if it is slow; returns on the first success, raises if none succeed"""
+        deadline = time.monotonic() + self.payment_timeout
+        pending = {self.provider_executor.submit(self.tracked_provider_call, payment, request_key)}
+        done, pending = wait(pending, timeout=self.hedge_delay)
+        
+        if not done and self.can_hedge():
+            if self.log_info:
+                self.logger.info("Payment provider slow, sending hedged request",
+                                 payment_id=payment['id'], hedge_delay_ms=int(self.hedge_delay * 1000))
+            self.metrics.record_business_event('payment_hedged')
+            pending.add(self.provider_executor.submit(self.tracked_provider_call, payment, request_key))
+        
+        # A fast failure must not beat a slower success, so failures are held until every leg has answered
+        failure = None
+        try:
+            while True:
+                for future in done:
+                    error = future.exception()
+                    if error is None:
+                        return
+                    failure = failure or error
+                
+                remaining = deadline - time.monotonic()
+                if not pending or remaining <= 0:
+                    break
+                done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        finally:
+            # The losing request cannot be interrupted mid-flight; this only drops it if it has not started
+            for future in pending:
+                future.cancel()
+        
+        raise failure or TimeoutError(f"Payment provider did not answer within {self.payment_timeout}s")
+    
+    def tracked_provider_call(self, payment: Dict, request_key: Optional[str] = None):
+        """Provider request that counts in-flight requests for hedge gating"""
+        with self._provider_lock:
+            self._provider_in_flight += 1
+        try:
+            self.send_provider_request(payment, request_key)
+        finally:
+            with self._provider_lock:
+                self._provider_in_flight -= 1
+    
+    def can_hedge(self) -> bool:
+        """Only hedge below 70% of provider capacity so backup requests don't worsen the tail under load"""
+        return self._provider_in_flight < self.provider_capacity * 0.7
+    
+    def call_payment_provider(self, payment: Dict, is_crash_test: bool = False,
+                              request_key: Optional[str] = None) -> bool:
+        """Call the external payment provider (mock); request_key makes repeated calls idempotent.
+        
+        Raises CircuitOpenError when the breaker refuses the call; other failures return False.
+        """
+        # Delivery address "123" forces a failure for testing (but doesn't affect circuit breaker)
+        if is_crash_test:
+            self.logger.warning("🧪 CRASH TEST - Address is exactly '123', forcing payment failure",
+                                payment_id=payment.get('id', 'unknown'), order_id=payment.get('order_id'))
             return False
-
+        
+        return self.guarded_provider_call(payment, lambda: self.send_provider_request(payment, request_key))
+    
+    def guarded_provider_call(self, payment: Dict, send: Callable[[], None]) -> bool:
+        """Run one provider attempt under the circuit breaker; returns False on any provider failure"""
+        payment_id = payment.get('id', 'unknown')
         try:
-            # The URL for the mock service endpoint
-            mock_url = f"{os.getenv('PAYMENT_MOCK_URL', 'http://payment-mock:5003')}/api/v1/payments/process"
-            self.logger.info(f"🌐 Making HTTP request to payment mock", payment_id=payment_id, url=mock_url)
-            
-            payload = {
-                'order_id': payment['order_id'],
-                'amount': payment['amount'],
-                'card_details': '...sensitive data...'
-            }
-            self.logger.info(f"📦 Request payload prepared", payment_id=payment_id, payload=payload)
-            
-            response = requests.post(
-                mock_url,
-                json=payload,
-                timeout=self.payment_timeout
+            # The guard records exactly one success or failure for this attempt
+            with self.circuit_breaker.guard():
+                send()
+        except CircuitOpenError:
+            self.logger.warning("⚡ Circuit breaker is open. Skipping payment provider call.", payment_id=payment_id)
+            raise
+        except ProviderRejectedError as e:
+            self.logger.warning(
+                "❌ Payment provider returned error",
+                payment_id=payment_id,
+                status_code=e.status,
+                response=e.body
             )
-            
-            self.logger.info(f"📨 HTTP response received", 
-                           payment_id=payment_id, 
-                           status_code=response.status_code, 
-                           response_text=response.text[:200])
-            
-            if response.status_code == 200:
-                self.logger.info("✅ Payment provider responded with success", payment_id=payment_id)
-                self.circuit_breaker.record_success()
-                return True
-            else:
-                self.logger.warning(
-                    "❌ Payment provider returned error",
-                    payment_id=payment_id,
-                    status_code=response.status_code,
-                    response=response.text
-                )
-                self.circuit_breaker.record_failure()
-                return False
-        except requests.exceptions.RequestException as e:
+            return False
+        except TimeoutError as e:
+            self.logger.error("🚨 Payment provider timed out", payment_id=payment_id, error=str(e))
+            return False
+        except urllib3.exceptions.HTTPError as e:
             self.logger.error("🚨 Payment provider request failed", payment_id=payment_id, error=str(e), exc_info=True)
-            self.circuit_breaker.record_failure()
             return False
         except Exception as e:
             self.logger.error("🚨 Unexpected error in payment provider call", payment_id=payment_id, error=str(e), exc_info=True)
-            self.circuit_breaker.record_failure()
             return False
+        
+        self.logger.debug("Payment provider responded with success", payment_id=payment_id)
+        return True
     
-    def record_payment_attempt(self, payment_id: str) -> int:
-        """Record a new payment attempt and return its ID."""
-        try:
-            # The status is explicitly set to PENDING on creation
-            result = self.db.execute_query("""
-                INSERT INTO payment_attempts (payment_id, attempt_number, status)
-                VALUES (
-                    %s, 
-                    (SELECT COALESCE(MAX(attempt_number), 0) + 1 FROM payment_attempts WHERE payment_id = %s),
-                    'PENDING'
-                )
-                    RETURNING id
-            """, (payment_id, payment_id), fetch='one')
-                
-            self.logger.info("Recorded new payment attempt", payment_id=payment_id, attempt_id=result['id'])
-            return result['id']
-                
-        except Exception as e:
-            self.logger.error("Failed to record payment attempt", error=str(e))
-            raise
+    def send_provider_request(self, payment: Dict, request_key: Optional[str] = None):
+        """POST the payment to the provider; raises ProviderRejectedError on a non-200 answer"""
+        payment_id = payment.get('id', 'unknown')
+        mock_url = self.payment_mock_url
+        
+        # order_id goes through the JSON encoder for quoting/escaping; amount is an integer in cents
+        body = PROVIDER_PAYLOAD_TEMPLATE % (orjson.dumps(payment['order_id']), payment['amount'])
+        if self.log_debug:
+            self.logger.debug("Making HTTP request to payment mock", payment_id=payment_id, url=mock_url, payload=body)
+        
+        headers = self.provider_headers
+        if request_key:
+            headers = {**headers, 'Idempotency-Key': request_key}
+        
+        response = self.http.request('POST', mock_url, body=body, headers=headers)
+        
+        if self.log_debug:
+            self.logger.debug("HTTP response received",
+                              payment_id=payment_id,
+                              status_code=response.status,
+                              response_text=response.data[:200].decode('utf-8', 'replace'))
+        
+        if response.status != 200:
+            raise ProviderRejectedError(response.status, response.data.decode('utf-8', 'replace'))
     
-    def update_payment_attempt(self, attempt_id: int, success: bool, error: str = None):
-        """Update a payment attempt after it has been processed."""
+    def record_payment_attempt(self, payment_id: str, attempt_number: int, success: bool,
+                               error: str = None) -> int:
+        """Record a completed payment attempt with its outcome and return its ID."""
         try:
             status = 'SUCCESS' if success else 'FAILED'
             
-            self.db.execute_query("""
-                    UPDATE payment_attempts
-                SET status = %s, error_message = %s, completed_at = CURRENT_TIMESTAMP
-                    WHERE id = %s
-            """, (status, error, attempt_id), fetch=None)
+            # Single INSERT with the final status instead of INSERT PENDING + UPDATE
+            result = self.db.execute_query(SQL_INSERT_ATTEMPT, (payment_id, attempt_number, status, error),
+                                           fetch='one', prepared_name='pay_insert_attempt')
+                
+            self.logger.debug("Recorded payment attempt", payment_id=payment_id, attempt_id=result['id'], status=status)
+            return result['id']
                 
-            self.logger.info("Updated payment attempt", attempt_id=attempt_id, status=status)
         except Exception as e:
-            self.logger.error("Failed to update payment attempt", error=str(e))
+            self.logger.error("Failed to record payment attempt", error=str(e))
             raise
     
-    def get_payment_by_id(self, payment_id: str) -> Optional[Dict]:
-        """Get payment by ID from database"""
+    def get_existing_payment(self, order_id: str, idempotency_key: str) -> Optional[Dict]:
+        """Get the payment that won an idempotency conflict (same order or same idempotency key)"""
         try:
-            payments = self.db.execute_query(
-                "SELECT * FROM payments WHERE id = %s",
-                (payment_id,),
-                fetch=True
+            return self.db.execute_query(
+                SQL_GET_EXISTING_PAYMENT,
+                (order_id, idempotency_key),
+                fetch='one',
+                prepared_name='pay_get_existing'
             )
-            return payments[0] if payments else None
         except Exception as e:
-            self.logger.error("Failed to get payment by ID", payment_id=payment_id, error=str(e))
+            self.logger.error("Failed to get existing payment", order_id=order_id, error=str(e))
             raise
     
-    def get_payment_by_order_id(self, order_id: str) -> Optional[Dict]:
-        """Get payment by order ID"""
+    def invalidate_cached_payment(self, payment: Dict):
+        """Drop a payment from the read cache under both lookup keys"""
+        with self._payment_cache_lock:
+            self._payment_cache.pop(('id', payment['id']), None)
+            self._payment_cache.pop(('order_id', payment['order_id']), None)
+    
+    def get_payment_with_attempts(self, key: str, by_order: bool = False) -> Optional[Dict]:
+        """Get a payment and its attempts in one round-trip (by payment ID, or by order ID; terminal payments are cached)"""
+        column = 'order_id' if by_order else 'id'
+        cache_key = (column, key)
+        with self._payment_cache_lock:
+            payment = self._payment_cache.get(cache_key)
+        if payment is not None:
+            return payment
+        
         try:
-            payments = self.db.execute_query(
-                "SELECT * FROM payments WHERE order_id = %s",
-                (order_id,),
-                fetch=True
-            )
-            return payments[0] if payments else None
+            payment = self.db.execute_query(SQL_GET_PAYMENT_WITH_ATTEMPTS[column], (key,), fetch='one',
+                                            prepared_name=f'pay_get_with_attempts_by_{column}')
         except Exception as e:
-            self.logger.error("Failed to get payment by order ID", order_id=order_id, error=str(e))
+            self.logger.error("Failed to get payment", key=key, by_order=by_order, error=str(e))
             raise
+        
+        if payment:
+            # Attempts arrive pre-serialized from Postgres and are emitted as-is
+            payment['attempts'] = orjson.Fragment(payment.pop('attempts_json'))
+            if payment['status'] in TERMINAL_PAYMENT_STATUSES:
+                with self._payment_cache_lock:
+                    self._payment_cache[cache_key] = payment
+        return payment
     
-    def get_payment_attempts(self, payment_id: str) -> List[Dict]:
-        """Get payment attempts for a payment"""
+    def mark_payment_processing(self, payment: Dict):
+        """Move a still pending payment to PROCESSING (runs on the slow-payment scheduler thread)"""
+        payment_id = payment['id']
         try:
-            return self.db.execute_query(
-                "SELECT * FROM payment_attempts WHERE payment_id = %s ORDER BY attempt_number",
-                (payment_id,),
-                fetch=True
-            )
+            with self.db.transaction():
+                # Never overwrite a terminal status written in the meantime
+                self.db.execute_query(SQL_MARK_PROCESSING, (_PROCESSING, payment_id, _PENDING),
+                                      prepared_name='pay_mark_processing')
+            self.invalidate_cached_payment(payment)
+            
+            self.logger.debug("Payment status updated", payment_id=payment_id, status=_PROCESSING)
         except Exception as e:
-            self.logger.error("Failed to get payment attempts", payment_id=payment_id, error=str(e))
-            return []
+            self.logger.error("Failed to update payment status", payment_id=payment_id, error=str(e))
     
-    def update_payment_status(self, payment_id: str, status: str, failure_reason: str = None):
+    def update_payment_status(self, payment: Dict, status: str, failure_reason: str = None):
         """Update payment status"""
+        payment_id = payment['id']
         try:
             with self.db.transaction():
-                with self.db.get_cursor() as cursor:
-                    cursor.execute("""
-                        UPDATE payments
-                        SET status = %s, failure_reason = %s, updated_at = CURRENT_TIMESTAMP
-                        WHERE id = %s
-                    """, (status, failure_reason, payment_id))
-                
-                self.logger.info("Payment status updated", payment_id=payment_id, status=status)
+                self.db.execute_query(SQL_UPDATE_STATUS, (status, failure_reason, payment_id),
+                                      prepared_name='pay_update_status')
+            self.invalidate_cached_payment(payment)
+            
+            self.logger.debug("Payment status updated", payment_id=payment_id, status=status)
                 
         except Exception as e:
             self.logger.error("Failed to update payment status", payment_id=payment_id, error=str(e))
             raise
     
-    def publish_payment_success_event(self, payment_id: str):
-        """Publish payment success event"""
+    def publish_payment_success_event(self, payment: Dict):
+        """Queue payment success event (delivery is batched by the producer)"""
+        payment_id = payment['id']
         try:
-            payment = self.get_payment_by_id(payment_id)
-            if not payment:
-                raise Exception(f"Payment {payment_id} not found")
-            
             event_data = {
                 'event_type': 'OrderPaid',
                 'payment_id': payment_id,
@@ -677,37 +1007,34 @@ class PaymentService(BaseService):
                 'timestamp': self.get_timestamp()
             }
             
-            success = self.events.publish_event('payment-events', event_data, payment['order_id'])
+            future = self.events.send_event('payment-events', event_data, payment['order_id'])
             
-            if success:
-                self.logger.info("Payment success event published", payment_id=payment_id)
+            if future is not None:
+                self.logger.debug("Payment success event queued", payment_id=payment_id)
             else:
                 self.logger.error("Failed to publish payment success event", payment_id=payment_id)
                 
         except Exception as e:
             self.logger.error("Failed to publish payment success event", payment_id=payment_id, error=str(e))
     
-    def publish_payment_failure_event(self, payment_id: str):
-        """Publish payment failure event"""
+    def publish_payment_failure_event(self, payment: Dict, failure_reason: str = None):
+        """Queue payment failure event (delivery is batched by the producer)"""
+        payment_id = payment['id']
         try:
-            payment = self.get_payment_by_id(payment_id)
-            if not payment:
-                raise Exception(f"Payment {payment_id} not found")
-            
             event_data = {
                 'event_type': 'PaymentFailed',
                 'payment_id': payment_id,
                 'order_id': payment['order_id'],
                 'amount': payment['amount'],
                 'payment_method': payment['payment_method'],
-                'failure_reason': payment.get('failure_reason', 'Unknown error'),
+                'failure_reason': failure_reason or 'Unknown error',
                 'timestamp': self.get_timestamp()
             }
             
-            success = self.events.publish_event('payment-events', event_data, payment['order_id'])
+            future = self.events.send_event('payment-events', event_data, payment['order_id'])
             
-            if success:
-                self.logger.info("Payment failure event published", payment_id=payment_id)
+            if future is not None:
+                self.logger.debug("Payment failure event queued", payment_id=payment_id)
             else:
                 self.logger.error("Failed to publish payment failure event", payment_id=payment_id)
                 
@@ -719,72 +1046,107 @@ class PaymentService(BaseService):
         def consume_events():
             self.logger.info("Starting event consumer for order events")
             
+            backoff = 1
             while True:
                 try:
                     self.events.process_events(
                         topics=['order-events'],
                         group_id='payment-service-group',
-                        handler_func=self.handle_order_event,
-                        max_messages=10
+                        handler_func=self.handle_order_events,
+                        max_messages=500,
+                        batch=True
                     )
-                    time.sleep(1)  # Small delay between polling
+                    backoff = 1
                 except Exception as e:
                     self.logger.error("Event consumer error", error=str(e))
-                    time.sleep(5)  # Wait before retrying
+                    time.sleep(backoff)  # Exponential backoff while Kafka is unavailable
+                    backoff = min(backoff * 2, 30)
         
         consumer_thread = threading.Thread(target=consume_events, daemon=True)
         consumer_thread.start()
         self.logger.info("Event consumer thread started")
     
-    def handle_order_event(self, topic: str, event_data: Dict, key: str):
-        """Handle order events (e.g., OrderCreated)"""
-        event_type = event_data.get('event_type')
-        # Handle both 'orderId' (from outbox) and 'order_id' (from other potential events)
-        order_id = event_data.get('orderId') or event_data.get('order_id')
+    def handle_order_events(self, events: List[Tuple[str, Dict, str]]):
+        """Handle a polled batch of order events; payments for the whole batch are created in one transaction"""
+        # One OrderCreated per order: redelivered duplicates inside a batch collapse here
+        orders_created = {}
+        for topic, event_data, key in events:
+            event_type = event_data.get('event_type')
+            # Handle both 'orderId' (from outbox) and 'order_id' (from other potential events)
+            order_id = event_data.get('orderId') or event_data.get('order_id')
             
-        self.logger.info(
-        "📥 Received new order event from Kafka",
-            event_type=event_type,
-        order_id=order_id,
-        message="POLL detected new event from order-events topic"
-        )
+            self.logger.debug("Received order event", event_type=event_type, order_id=order_id)
             
-        try:
             if event_type == 'OrderCreated':
-                self.handle_order_created(event_data, order_id)
+                if order_id in self._recent_orders:
+                    self.logger.debug("Duplicate order event skipped", order_id=order_id)
+                    continue
+                orders_created.setdefault(order_id, event_data)
             # Future event types can be handled here
             # elif event_type == 'OrderCancelled':
             #     self.handle_order_cancelled(event_data, order_id)
             else:
                 self.logger.warning("Unknown order event type", event_type=event_type)
+        
+        if not orders_created:
+            return
+        
+        try:
+            with self.db.transaction():
+                started = [self.create_payment_from_event(event_data, order_id)
+                           for order_id, event_data in orders_created.items()]
+            handled = list(orders_created)
         except Exception as e:
-            self.logger.error("Failed to handle order event", error=str(e), order_id=order_id)
+            # One bad event must not lose the rest of the batch
+            self.logger.error("Batch payment creation failed, retrying events one by one",
+                              size=len(orders_created), error=str(e))
+            started, handled = [], []
+            for order_id, event_data in orders_created.items():
+                try:
+                    started.append(self.create_payment_from_event(event_data, order_id))
+                    handled.append(order_id)
+                except Exception as e:
+                    self.logger.error("Failed to handle order event", error=str(e), order_id=order_id)
+        
+        # Remembered only once committed, so a rolled-back order is still retried on redelivery
+        for order_id in handled:
+            self._recent_orders[order_id] = True
+        
+        # Processing starts only after the payment rows are committed. A full queue slows the consumer,
+        # but the wait is bounded so the consumer keeps polling often enough to stay in its group;
+        # past the deadline the committed payments are queued over the limit rather than dropped
+        deadline = time.monotonic() + self.consumer_slot_wait
+        for item in started:
+            if item is None:
+                continue
+            payment, is_crash_test = item
+            slot_held = self.payment_slots.acquire(timeout=max(0.0, deadline - time.monotonic()))
+            if not slot_held:
+                self.logger.warning("Payment queue saturated, queueing order payment over the limit",
+                                    payment_id=payment['id'])
+            self.submit_payment(payment, is_crash_test, slot_held)
+            self.logger.debug("Payment processing initiated from order event",
+                              payment_id=payment['id'], order_id=payment['order_id'])
+            self.metrics.record_business_event('payment_initiated_from_event', 'success')
     
-    def handle_order_created(self, event_data: Dict, order_id: str):
-        """Handle OrderCreated event to initiate payment."""
-        if not all(k in event_data for k in ['totalAmount', 'paymentMethod', 'userId']):
-            self.logger.warning("Incomplete order data for payment", event_data=event_data)
-            return
+    def create_payment_from_event(self, event_data: Dict, order_id: str) -> Optional[Tuple[Dict, bool]]:
+        """Create the payment for an OrderCreated event; returns (payment, is_crash_test) or None if nothing to start"""
+        if not _ORDER_CREATED_REQUIRED <= event_data.keys():
+            self.logger.warning("Incomplete order data for payment", event_preview=event_preview(event_data))
+            return None
             
         amount = event_data['totalAmount']
         payment_method = event_data['paymentMethod']
         
         # Log delivery address for debugging
         delivery_address = event_data.get('deliveryAddress', {})
-        self.logger.info("📍 Order delivery address", 
-                        order_id=order_id, 
-                        delivery_address=delivery_address)
+        self.logger.debug("Order delivery address", order_id=order_id, delivery_address=delivery_address)
 
-        # Check for existing payment (idempotency)
-        if self.get_payment_by_order_id(order_id):
-            self.logger.info("Payment already initiated for order", order_id=order_id)
-            return
-            
-        # Create payment record
+        # Create payment record (idempotent: redelivered events find the existing payment)
         payment_id = generate_id('pay_')
         idempotency_key = self.generate_idempotency_key(order_id, amount, payment_method)
             
-        payment_record = self.create_payment_record(
+        payment, created = self.create_payment_record(
             payment_id=payment_id,
             order_id=order_id,
             amount=amount,
@@ -792,32 +1154,29 @@ class PaymentService(BaseService):
             idempotency_key=idempotency_key
         )
         
-
+        if not created:
+            self.logger.info("Payment already initiated for order", order_id=order_id)
+            return None
         
-        # Start async payment processing (for ALL orders, not just crash tests)
-        threading.Thread(
-            target=self.process_payment_async,
-            args=(payment_id,),
-            daemon=True
-        ).start()
-            
-        self.logger.info(
-            "💳 Payment processing initiated from order event",
-            payment_id=payment_id,
-            order_id=order_id,
-            message="Started async payment processing thread"
-        )
-        self.metrics.record_business_event('payment_initiated_from_event', 'success')
+        # Async payment processing runs for ALL orders, not just crash tests
+        return payment, self.crash_test_enabled and is_crash_test_address(delivery_address)
     
     def get_timestamp(self) -> str:
         """Get current timestamp in ISO format"""
-        return datetime.now(timezone.utc).isoformat()
+        return iso_now_fast()
 
 
 # ========================================
 # Application Entry Point
 # ========================================
 
+def create_app():
+    """WSGI application factory used by gunicorn"""
+    service = PaymentService()
+    service.logger.info("💳 Starting Payment Service under gunicorn")
+    return service.app
+
+
 if __name__ == '__main__':
     try:
         # Create and run service
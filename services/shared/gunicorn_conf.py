@@ -0,0 +1,35 @@
+"""
+Pizza Order System - Gunicorn Configuration
+Event-Driven Saga Architecture
+
+Production WSGI server settings shared by all HTTP microservices
+"""
+
+import os
+
+
+# Bind to the same port the Flask dev server would use
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# gevent workers monkey-patch sockets and time.sleep before the app is loaded,
+# so blocking HTTP/Kafka calls yield instead of pinning a worker.
+# Small fixed default: every worker opens its own DB pool (up to PG_POOL_MAX) and joins the
+# Kafka consumer group, so workers x PG_POOL_MAX must stay under Postgres max_connections
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '60'))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+
+# Log to stdout/stderr like the rest of the services
+accesslog = '-'
+errorlog = '-'
+loglevel = os.getenv('LOG_LEVEL', 'INFO').lower()
+
+
+def post_fork(server, worker):
+    """Make psycopg2 cooperative under gevent so DB waits yield to other requests"""
+    if worker_class == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()